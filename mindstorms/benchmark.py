@@ -0,0 +1,278 @@
+
+import os
+import sys
+import json
+import glob
+import time
+import argparse
+import tempfile
+import threading
+import subprocess
+from types import SimpleNamespace
+
+import simulator
+import coordinator
+
+# Motor commands that mean the robot started to move
+MOTION_KINDS = ('on_for_degrees', 'run_forever')
+
+# Places the robots of a simulated fleet start from, one each
+FLEET_PLACES = ('home', 'trainstation', 'colorsLineEnd', 'parking')
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+class Benchmark(object):
+    '''
+    Replays directive streams against a MindstormsGadget running on the simulated brick and measures
+    the directive to motion latency, the trip durations and the CPU used per directive.
+    A stream is a JSON list of {"payload": {...}} entries. An entry is sent once the gadget is idle,
+    or "after" seconds of virtual time after the previous one if given, to measure preemption.
+    '''
+
+    def __init__(self, speedup=1.0, timeout=120.0, stateFile=None, colorIndexFile=None):
+        self.speedup = speedup
+        self.timeout = timeout
+        simulator.reset(speedup)
+        simulator.install()
+        import lego
+        # The sensors are polled on the virtual clock, as often per virtual second as on the brick
+        lego.CLOCK = simulator.brick.clock
+        # Every run starts from a blank state and color index, so two runs of a stream give the same results
+        self.directory = None
+        if stateFile is None or colorIndexFile is None:
+            self.directory = tempfile.TemporaryDirectory(prefix='lego-benchmark-')
+            stateFile = stateFile or os.path.join(self.directory.name, 'state.bin')
+            colorIndexFile = colorIndexFile or os.path.join(self.directory.name, 'colorIndex.json')
+        self.gadget = lego.MindstormsGadget(stateFile, colorIndexFile)
+        self.brick = simulator.brick
+        self.brick.field = simulator.SimField(self.gadget.toPlaces, self.gadget.targets,
+                                              self.gadget.wheelRadius, self.gadget.distanceWheels)
+
+    def idle(self):
+        executor = self.gadget.executor
+        return executor.current is None and not executor.pending and self.brick.idle()
+
+    def waitIdle(self, until=None):
+        deadline = time.monotonic() + self.timeout if until is None else until
+        while not self.idle():
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.005)
+        return True
+
+    def home(self, place='home'):
+        # Every stream starts with the robot at home, with the default settings
+        self.gadget.executor.stop()
+        self.waitIdle()
+        x, y, orientation = self.gadget.toPlaces[place]
+        self.brick.field.place(x, y, orientation)
+        self.gadget.setPosition(x, y, orientation)
+        self.gadget.state.update(fromPlace=place, toPlace=place, target='none', remoteControl=False)
+
+    def replay(self, stream):
+        self.home()
+        results = []
+        for index, entry in enumerate(stream):
+            nextEntry = stream[index + 1] if index + 1 < len(stream) else {}
+            tripsBefore = len(self.gadget.tripTimes)
+            started = time.monotonic()
+            cpuStarted = time.process_time()
+
+            directive = SimpleNamespace(payload=json.dumps(entry['payload']).encode('utf-8'))
+            self.gadget.on_custom_mindstorms_gadget_control(directive)
+
+            if 'after' in nextEntry:
+                # The next directive does not wait for this one to finish
+                time.sleep(nextEntry['after'] / self.speedup)
+                finished = not self.idle()
+            else:
+                finished = self.waitIdle()
+            ended = time.monotonic()
+
+            motion = [at for at, address, kind in list(self.brick.commands) if at >= started and kind in MOTION_KINDS]
+            trips = list(self.gadget.tripTimes)[tripsBefore:] if len(self.gadget.tripTimes) > tripsBefore else []
+            results.append({
+                'type': entry['payload'].get('type'),
+                'latency': round(min(motion) - started, 4) if motion else None,
+                'duration': round((ended - started) * self.speedup, 3),
+                'trips': [round(trip[-1] * self.speedup, 3) for trip in trips],
+                'cpu': round(time.process_time() - cpuStarted, 4),
+                'completed': finished
+            })
+        return results
+
+    @staticmethod
+    def summary(results):
+        latencies = [result['latency'] for result in results if result['latency'] is not None]
+        trips = [trip for result in results for trip in result['trips']]
+        return {
+            'directives': len(results),
+            'latencyP50': percentile(latencies, 0.5),
+            'latencyP95': percentile(latencies, 0.95),
+            'latencyMax': max(latencies) if latencies else None,
+            'trips': len(trips),
+            'tripMean': round(sum(trips) / len(trips), 3) if trips else None,
+            'duration': round(sum(result['duration'] for result in results), 3),
+            'cpuPerDirective': round(sum(result['cpu'] for result in results) / len(results), 4) if results else None
+        }
+
+
+def member(args):
+    # A simulated robot of a fleet, in its own process as the simulated brick is global. It is terminated
+    # at the end, so its files are kept in a directory of the fleet run that removes them
+    benchmark = Benchmark(args.speedup, args.timeout, os.path.join(args.directory, 'state.bin'),
+                          os.path.join(args.directory, 'colorIndex.json'))
+    benchmark.home(args.place)
+    if not benchmark.gadget.joinFleet(args.socket, args.member):
+        return 1
+    while benchmark.gadget.fleet.connected:
+        time.sleep(0.1)
+    return 0
+
+
+def fleet(args, streams):
+    '''
+    Runs the directives of the streams on a fleet of simulated robots, each one in its own process, through the
+    coordinator. The directives are all submitted at once and the coordinator spreads them over the robots.
+    '''
+    # The socket and the files of every robot are removed with this directory at the end of the run
+    workspace = tempfile.TemporaryDirectory(prefix='lego-fleet-')
+    path = os.path.join(workspace.name, 'fleet.sock')
+    server = coordinator.Server(path, coordinator.Coordinator())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    output = None if args.verbose else subprocess.DEVNULL
+    members = []
+    for index, place in enumerate(FLEET_PLACES[:args.fleet]):
+        name = 'robot{}'.format(index + 1)
+        os.mkdir(os.path.join(workspace.name, name))
+        members.append(subprocess.Popen([sys.executable, os.path.abspath(__file__), '--member', name, '--place', place,
+                                         '--socket', path, '--directory', os.path.join(workspace.name, name),
+                                         '--speedup', str(args.speedup)],
+                                        stdout=output, stderr=output))
+    try:
+        controller = None
+        deadline = time.monotonic() + 60
+        while controller is None or len(controller.status()['robots']) < len(members):
+            if time.monotonic() >= deadline:
+                print('The robots did not join the fleet')
+                return 1
+            time.sleep(0.2)
+            if controller is None:
+                controller = coordinator.Controller(path)
+
+        report = {}
+        for stream in streams:
+            with open(stream) as entries:
+                payloads = [entry['payload'] for entry in json.load(entries)]
+            started = time.monotonic()
+            for payload in payloads:
+                controller.submit(payload)
+            results = controller.results(len(payloads))
+            elapsed = (time.monotonic() - started) * args.speedup
+            robots = {}
+            for result in results:
+                robots[result['robot']] = robots.get(result['robot'], 0) + 1
+            report[os.path.basename(stream)] = {
+                'directives': len(results),
+                'failed': sum(1 for result in results if result['status'] != 'done'),
+                'duration': round(elapsed, 3),
+                'actionsPerMinute': round(60 * len(results) / elapsed, 2) if elapsed else None,
+                'robots': robots,
+                'waitMean': round(sum(result['wait'] for result in results) * args.speedup / len(results), 3)
+            }
+        status = controller.status()
+        controller.close()
+    finally:
+        for process in members:
+            process.terminate()
+        for process in members:
+            process.wait()
+        server.shutdown()
+        server.server_close()
+        workspace.cleanup()
+
+    print('{:<16} {:>6} {:>4} {:>6} {:>10} {:>10} {:>10}'.format(
+        'stream', 'robots', 'dirs', 'failed', 'duration', 'wait mean', 'actions/min'))
+    for name, entry in report.items():
+        print('{:<16} {:>6} {:>4} {:>6} {:>10} {:>10} {:>10}'.format(
+            name, len(members), entry['directives'], entry['failed'], entry['duration'], entry['waitMean'],
+            str(entry['actionsPerMinute'])))
+    print('Reservations {}, delayed by the field {}, moves to make way {}, jobs per robot {}'.format(
+        status['reservations'], status['waits'], status['moves'],
+        {name: robot['jobs'] for name, robot in status['robots'].items()}))
+
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(report, output, indent=2)
+    return 0
+
+
+def main():
+    directory = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Replays directive streams on the simulated brick and reports latencies')
+    parser.add_argument('streams', nargs='*', help='stream files, all the files in streams/ by default')
+    parser.add_argument('--speedup', type=float, default=1.0, help='how much faster than real time the motors run and the sensors are polled')
+    parser.add_argument('--timeout', type=float, default=120.0, help='seconds to wait for a directive to finish')
+    parser.add_argument('--json', help='file to write the full report to')
+    parser.add_argument('--max-latency', type=float, help='fail if a directive to motion latency is longer, in seconds')
+    parser.add_argument('--fleet', type=int, help='number of simulated robots sharing the field through the coordinator')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the robots of the fleet')
+    parser.add_argument('--member', help=argparse.SUPPRESS)
+    parser.add_argument('--place', default='home', help=argparse.SUPPRESS)
+    parser.add_argument('--socket', help=argparse.SUPPRESS)
+    parser.add_argument('--directory', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.fleet and args.speedup != 1:
+        # The coordinator reserves the field in real seconds, a faster clock would make every window too long
+        parser.error('--fleet runs in real time, it cannot be combined with --speedup')
+
+    streams = [os.path.abspath(path) for path in args.streams] or sorted(glob.glob(os.path.join(directory, 'streams', '*.json')))
+    # The gadget loads its images and sounds relative to its own directory
+    os.chdir(directory)
+    if args.member:
+        return member(args)
+    if args.fleet:
+        return fleet(args, streams)
+    benchmark = Benchmark(args.speedup, args.timeout)
+
+    report = {}
+    for path in streams:
+        with open(path) as stream:
+            results = benchmark.replay(json.load(stream))
+        # The worker counters add up from one stream to the next
+        report[os.path.basename(path)] = {'summary': Benchmark.summary(results), 'directives': results,
+                                          'stats': benchmark.gadget.stats()}
+
+    print('{:<16} {:>4} {:>10} {:>10} {:>10} {:>6} {:>10} {:>10} {:>10}'.format(
+        'stream', 'dirs', 'lat p50', 'lat p95', 'lat max', 'trips', 'trip mean', 'duration', 'cpu/dir'))
+    for name, entry in report.items():
+        summary = entry['summary']
+        print('{:<16} {:>4} {:>10} {:>10} {:>10} {:>6} {:>10} {:>10} {:>10}'.format(
+            name, summary['directives'], str(summary['latencyP50']), str(summary['latencyP95']), str(summary['latencyMax']),
+            summary['trips'], str(summary['tripMean']), summary['duration'], str(summary['cpuPerDirective'])))
+    # The command history of the executor is only in the JSON report
+    for name, stats in benchmark.gadget.stats().items():
+        if name != 'executor':
+            print('{} stats: {}'.format(name, stats))
+
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(report, output, indent=2)
+
+    if args.max_latency is not None:
+        slow = [name for name, entry in report.items()
+                if entry['summary']['latencyMax'] is not None and entry['summary']['latencyMax'] > args.max_latency]
+        if slow:
+            print('Directive to motion latency over {}s in: {}'.format(args.max_latency, ', '.join(slow)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
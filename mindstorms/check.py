@@ -0,0 +1,238 @@
+import os
+import json
+import time
+import tempfile
+import unittest
+import threading
+from types import SimpleNamespace
+
+import simulator
+from benchmark import Benchmark
+
+# The planners and workers are checked on their own too, lego needs the simulated devices to be imported
+simulator.install()
+import lego
+
+# Speedup of the simulated clock, the checks wait on motions and attacks in virtual time
+SPEEDUP = 5.0
+
+# Weapon motor port of the simulated brick
+WEAPON = 'outA'
+
+bench = None
+
+
+def setUpModule():
+    # A single gadget for every check: the workers of a gadget keep running once it is created
+    global bench
+    bench = Benchmark(SPEEDUP, timeout=60.0)
+
+
+def send(payload):
+    bench.gadget.on_custom_mindstorms_gadget_control(SimpleNamespace(payload=json.dumps(payload).encode('utf-8')))
+
+
+def waitFor(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+def sequenceEvents(since):
+    return [payload for at, namespace, name, payload in list(bench.brick.events)
+            if at >= since and name == lego.EventName.SEQUENCE.value]
+
+
+def motorCommands(since, address=None):
+    return [(at, kind) for at, port, kind in list(bench.brick.commands)
+            if at >= since and (address is None or port == address)]
+
+
+class RouteCheck(unittest.TestCase):
+
+    def test_home_is_left_forward_and_entered_in_reverse(self):
+        routes = bench.gadget.routes
+        self.assertEqual(routes.route('home', 'home'), [])
+        self.assertEqual(routes.route('home', 'heliport')[0], ('homeEntrance', 'forward'))
+        self.assertEqual(routes.route('heliport', 'home')[-1], ('home', 'reverse'))
+
+    def test_unknown_place_has_no_route(self):
+        self.assertIsNone(bench.gadget.routes.route('home', 'nowhere'))
+
+
+class TrajectoryCheck(unittest.TestCase):
+
+    def setUp(self):
+        self.planner = lego.TrajectoryPlanner(bench.gadget.wheelRadius, bench.gadget.distanceWheels)
+        self.degrees = 500.0 / bench.gadget.wheelRadius * 180.0 / lego.math.pi
+
+    def test_straight_line(self):
+        segments = self.planner.plan((0.0, 0.0, 0.0), [(250.0, 0.0, False), (500.0, 0.0, False)])
+        self.assertEqual(len(segments), 1)
+        self.assertAlmostEqual(segments[0][0], self.degrees, delta=1.0)
+        self.assertAlmostEqual(segments[0][1], self.degrees, delta=1.0)
+
+    def test_reverse(self):
+        segments = self.planner.plan((0.0, 0.0, 0.0), [(-500.0, 0.0, True)])
+        self.assertEqual(len(segments), 1)
+        self.assertAlmostEqual(segments[0][0], -self.degrees, delta=1.0)
+
+    def test_trip_ends_at_the_place(self):
+        bench.home()
+        send({'type': 'goSomewhere', 'place': 'heliport', 'speed': 100})
+        self.assertTrue(bench.waitIdle())
+        x, y, orientation = bench.gadget.toPlaces['heliport']
+        fieldX, fieldY, fieldOrientation = bench.brick.field.pose()
+        self.assertLess(lego.math.hypot(fieldX - x, fieldY - y), 20.0)
+        self.assertEqual(bench.gadget.state.read().fromPlace, 'heliport')
+
+
+class SnapshotCheck(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory(prefix='lego-check-')
+        self.snapshot = lego.StateSnapshot(os.path.join(self.directory.name, 'state.bin'))
+
+    def tearDown(self):
+        self.snapshot.map.close()
+        self.snapshot.file.close()
+        self.directory.cleanup()
+
+    def test_torn_write_keeps_the_previous_state(self):
+        self.snapshot.write((10.0, 20.0, 0.5, 40, False, 'home', 'none', 'blade', ''))
+        self.snapshot.write((30.0, 40.0, 1.5, 60, False, 'heliport', 'tree', 'hammer', ''))
+        self.assertEqual(self.snapshot.read()['fromPlace'], 'heliport')
+        # A write cut in the middle of the latest slot
+        slot = self.snapshot.sequence % 2
+        offset = slot * self.snapshot.slotSize + 8
+        self.snapshot.map[offset:offset + 8] = b'\xff' * 8
+        state = self.snapshot.read()
+        self.assertEqual((state['fromPlace'], state['tool'], state['speed']), ('home', 'blade', 40))
+        self.assertEqual(state['sequence'], 1)
+
+    def test_unpackable_state_is_skipped(self):
+        self.snapshot.write((10.0, 20.0, 0.5, 40, False, 'home', 'none', 'blade', ''))
+        self.snapshot.write((10.0, 20.0, 0.5, None, False, 'home', 'none', 'blade', ''))
+        self.assertEqual(self.snapshot.stats()['writes'], 1)
+        self.assertEqual(self.snapshot.read()['speed'], 40)
+
+
+class EventSenderCheck(unittest.TestCase):
+
+    def test_pending_events_are_coalesced(self):
+        sent = []
+        release = threading.Event()
+
+        def sendEvent(name, payload):
+            sent.append((name, payload))
+            release.wait(5.0)
+
+        sender = lego.EventSender(sendEvent, minInterval=0.0)
+        sender.post(lego.EventName.FINDCOLOR, {'color': 'Red'})
+        self.assertTrue(waitFor(lambda: sent))
+        # The sender is busy with the first event, the next ones are queued
+        for speed in (20, 40, 60):
+            sender.post(lego.EventName.SETSPEED, {'speed': speed})
+        sender.post(lego.EventName.FINDCOLOR, {'color': 'Blue'})
+        sender.post(lego.EventName.FINDCOLOR, {'color': 'Green'})
+        release.set()
+        self.assertTrue(waitFor(lambda: sender.stats()['sent'] == 4))
+        self.assertEqual(sent[1:], [(lego.EventName.SETSPEED, {'speed': 60}),
+                                    (lego.EventName.FINDCOLOR, {'color': 'Blue'}),
+                                    (lego.EventName.FINDCOLOR, {'color': 'Green'})])
+        self.assertEqual(sender.stats()['merged'], 2)
+
+
+class PreemptionCheck(unittest.TestCase):
+
+    def setUp(self):
+        bench.home()
+
+    def test_stop_preempts_a_trip(self):
+        started = time.monotonic()
+        send({'type': 'goSomewhere', 'place': 'heliport', 'speed': 20})
+        self.assertTrue(waitFor(lambda: motorCommands(started)))
+        time.sleep(0.5 / SPEEDUP)
+        send({'type': 'stop'})
+        self.assertTrue(bench.waitIdle())
+        command = bench.gadget.executor.history[-1]
+        self.assertEqual((command.name, command.status), ('goSomewhere', 'preempted'))
+        self.assertIsNone(bench.gadget.state.read().fromPlace)
+
+    def test_new_directive_preempts_a_sequence(self):
+        started = time.monotonic()
+        send({'type': 'sequence', 'steps': [{'type': 'goSomewhere', 'place': 'heliport', 'speed': 20},
+                                            {'type': 'goSomewhere', 'place': 'parking', 'speed': 20}]})
+        self.assertTrue(waitFor(lambda: motorCommands(started)))
+        time.sleep(0.5 / SPEEDUP)
+        send({'type': 'goSomewhere', 'place': 'trainstation', 'speed': 100})
+        self.assertTrue(bench.waitIdle())
+        self.assertTrue(waitFor(lambda: sequenceEvents(started)))
+        event = sequenceEvents(started)[-1]
+        self.assertEqual((event['status'], event['step']), ('preempted', 0))
+        self.assertEqual(bench.gadget.state.read().fromPlace, 'trainstation')
+
+    def test_stop_during_an_attack_stops_the_weapon(self):
+        send({'type': 'goSomewhere', 'place': 'heliport', 'speed': 100})
+        self.assertTrue(bench.waitIdle())
+        send({'type': 'setTarget', 'target': 'tree'})
+        started = time.monotonic()
+        send({'type': 'useTool', 'tool': 'blade'})
+        self.assertTrue(waitFor(lambda: ('on_for_degrees' in [kind for at, kind in motorCommands(started, WEAPON)])))
+        stoppedAt = time.monotonic()
+        send({'type': 'stop'})
+        self.assertTrue(bench.waitIdle())
+        # Let a move that was not cancelled show up
+        time.sleep(1.0 / SPEEDUP)
+        command = bench.gadget.executor.history[-1]
+        self.assertEqual((command.name, command.status), ('useTool', 'preempted'))
+        self.assertNotIn('on_for_degrees', [kind for at, kind in motorCommands(stoppedAt, WEAPON)])
+
+
+class ValidationCheck(unittest.TestCase):
+
+    def setUp(self):
+        bench.home()
+
+    def test_invalid_step_rejects_the_whole_sequence(self):
+        tool = bench.gadget.state.read().tool
+        started = time.monotonic()
+        send({'type': 'sequence', 'steps': [{'type': 'goSomewhere', 'place': 'heliport', 'speed': 50},
+                                            {'type': 'useTool', 'tool': 'banana'}]})
+        self.assertTrue(bench.waitIdle())
+        self.assertTrue(waitFor(lambda: sequenceEvents(started)))
+        self.assertEqual(sequenceEvents(started)[-1]['status'], 'rejected')
+        self.assertEqual(motorCommands(started), [])
+        self.assertEqual(bench.gadget.state.read().tool, tool)
+        self.assertEqual(bench.gadget.state.read().fromPlace, 'home')
+
+    def test_invalid_speed_is_rejected(self):
+        speed = bench.gadget.state.read().speed
+        for value in (None, 'fast', 250, True):
+            send({'type': 'setSpeed', 'speed': value})
+            self.assertEqual(bench.gadget.state.read().speed, speed)
+        send({'type': 'setSpeed', 'speed': 30})
+        self.assertEqual(bench.gadget.state.read().speed, 30)
+        send({'type': 'setSpeed', 'speed': speed})
+
+    def test_bad_speed_does_not_break_the_next_saves(self):
+        gadget = bench.gadget
+        speed = gadget.state.read().speed
+        gadget.state.update(speed=None)
+        try:
+            gadget.saveState()
+        finally:
+            gadget.state.update(speed=speed)
+        writes = gadget.snapshot.stats()['writes']
+        send({'type': 'goSomewhere', 'place': 'heliport', 'speed': 100})
+        self.assertTrue(bench.waitIdle())
+        self.assertGreater(gadget.snapshot.stats()['writes'], writes)
+        self.assertEqual(gadget.snapshot.read()['fromPlace'], 'heliport')
+
+
+if __name__ == '__main__':
+    # The gadget logs every command, only the output of the failed checks is shown
+    unittest.main(buffer=True)
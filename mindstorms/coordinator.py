@@ -0,0 +1,424 @@
+
+import os
+import sys
+import json
+import math
+import time
+import socket
+import argparse
+import threading
+import socketserver
+from collections import deque
+
+# Unix socket the gadgets and the controllers connect to
+FLEET_SOCKET = '/tmp/lego-fleet.sock'
+
+# Two robots whose paths get closer than this, in milimiters, cannot be on them at the same time
+ROBOT_CLEARANCE = 200.0
+
+# How far ahead a trip can be scheduled, in seconds, before the robot is told the field is blocked
+RESERVATION_HORIZON = 120.0
+
+# Speed an idle robot moves at to clear the way for another one
+MAKE_WAY_SPEED = 50
+
+
+def segmentDistance(first, second):
+    # Shortest distance between two segments ((x1, y1), (x2, y2)), a segment can be a single point
+    (ax, ay), (bx, by) = first
+    (cx, cy), (dx, dy) = second
+    if _segmentsCross(first, second):
+        return 0.0
+    return min(_pointDistance((ax, ay), second), _pointDistance((bx, by), second),
+               _pointDistance((cx, cy), first), _pointDistance((dx, dy), first))
+
+
+def _pointDistance(point, segment):
+    (px, py), ((ax, ay), (bx, by)) = point, segment
+    length = (bx - ax) ** 2 + (by - ay) ** 2
+    if length == 0:
+        return math.hypot(px - ax, py - ay)
+    along = max(0.0, min(1.0, ((px - ax) * (bx - ax) + (py - ay) * (by - ay)) / length))
+    return math.hypot(px - ax - along * (bx - ax), py - ay - along * (by - ay))
+
+
+def _segmentsCross(first, second):
+    def side(a, b, c):
+        return (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+    (a, b), (c, d) = first, second
+    return side(a, b, c) * side(a, b, d) < 0 and side(c, d, a) * side(c, d, b) < 0
+
+
+class Window(object):
+    '''
+    Time window, in seconds of the coordinator clock, during which a robot occupies a segment of the field.
+    A parked robot occupies the point of its place until it leaves, so its window has no end.
+    '''
+
+    def __init__(self, robot, shape, start, end=math.inf):
+        self.robot = robot
+        self.shape = shape
+        self.start = start
+        self.end = end
+
+    def overlaps(self, other, clearance):
+        return (self.start < other.end and other.start < self.end
+                and segmentDistance(self.shape, other.shape) < clearance)
+
+
+class Robot(object):
+    '''
+    A gadget connected to the coordinator, with the job it is running if any.
+    '''
+
+    def __init__(self, name, connection):
+        self.name = name
+        self.connection = connection
+        self.place = None
+        self.job = None
+        self.jobs = 0
+
+
+class Job(object):
+    '''
+    A directive submitted to the fleet, for a given robot or for the first suitable one.
+    '''
+
+    def __init__(self, ticket, payload, robot, connection):
+        self.ticket = ticket
+        self.payload = payload
+        self.robot = robot
+        self.connection = connection
+        self.submittedAt = time.monotonic()
+        self.startedAt = None
+
+
+class Coordinator(object):
+    '''
+    Holds the field model shared by the gadgets and hands out time windows on it. A gadget asks for its whole
+    trip before driving it and is told how long to wait so that no leg comes closer than the clearance to the
+    leg or the parked place of another robot at the same time. The directives submitted by the controllers are
+    queued and dispatched to the idle robots, the ones going to a place to the idle robot closest to it, so the
+    robots work in parallel wherever their paths do not cross. An idle robot parked in the way of a trip
+    is sent to the closest free place.
+    '''
+
+    def __init__(self, clearance=ROBOT_CLEARANCE, horizon=RESERVATION_HORIZON):
+        self.clearance = clearance
+        self.horizon = horizon
+        self.places = None
+        self.robots = {}
+        self.windows = []
+        self.jobs = deque()
+        self.tickets = 0
+        self.reservations = 0
+        self.waits = 0
+        self.moves = 0
+        self.lock = threading.RLock()
+
+    def join(self, name, connection, message):
+        with self.lock:
+            if self.places is None:
+                self.places = message['places']
+            elif message['places'] != self.places:
+                return 'the field of {} does not match the field of the fleet'.format(name)
+            robot = Robot(name, connection)
+            self.robots[name] = robot
+            self._park(robot, message.get('place'), time.monotonic())
+            print('Robot {} joined at {}'.format(name, robot.place))
+            self._schedule()
+        return None
+
+    def leave(self, name, connection):
+        with self.lock:
+            robot = self.robots.get(name)
+            if robot is None or robot.connection is not connection:
+                return
+            del self.robots[name]
+            self.windows = [window for window in self.windows if window.robot != name]
+            if robot.job is not None:
+                self._reply(robot.job, robot.name, 'lost')
+            print('Robot {} left'.format(name))
+
+    def reserve(self, name, trip):
+        '''
+        Books the legs of a trip back to back at the earliest time none of them is too close to another robot.
+        Returns (delay, None) with the seconds to wait before starting, or (None, robot) with the robot in the way.
+        :param trip: list of (fromPlace, toPlace, seconds) legs
+        '''
+        with self.lock:
+            now = time.monotonic()
+            self.windows = [window for window in self.windows if window.end > now]
+            others = [window for window in self.windows if window.robot != name]
+            shapes = [(self._point(fromPlace), self._point(toPlace)) for fromPlace, toPlace, seconds in trip]
+            blocker = None
+            # The trip can only become possible when a window of another robot ends
+            for start in sorted({now} | {window.end for window in others if window.end < now + self.horizon}):
+                windows = []
+                at = start
+                for shape, (fromPlace, toPlace, seconds) in zip(shapes, trip):
+                    window = Window(name, shape, at, at + seconds)
+                    conflict = next((other for other in others if window.overlaps(other, self.clearance)), None)
+                    if conflict is not None:
+                        blocker = conflict
+                        break
+                    windows.append(window)
+                    at = window.end
+                else:
+                    # The robot leaves its place when the trip starts and stays parked where it ends
+                    for window in self.windows:
+                        if window.robot == name and window.end == math.inf:
+                            window.end = start
+                    self.windows.extend(windows)
+                    self.windows.append(Window(name, (self._point(trip[-1][1]),) * 2, at))
+                    self.reservations += 1
+                    if start > now:
+                        self.waits += 1
+                    return start - now, None
+            if blocker.end == math.inf:
+                # Parked in the way, waiting does not help unless it moves
+                self._makeWay(blocker.robot, shapes)
+            return None, blocker.robot
+
+    def arrived(self, name, place):
+        # The robot ended its trip, early or late, or stopped somewhere unknown when place is None
+        with self.lock:
+            robot = self.robots.get(name)
+            if robot is not None:
+                self._park(robot, place, time.monotonic())
+
+    def submit(self, payload, robot, connection):
+        with self.lock:
+            self.tickets += 1
+            job = Job(self.tickets, payload, robot, connection)
+            self.jobs.append(job)
+            self._schedule()
+            return job.ticket
+
+    def finished(self, name, ticket, status):
+        with self.lock:
+            robot = self.robots.get(name)
+            if robot is None or robot.job is None or robot.job.ticket != ticket:
+                return
+            self._reply(robot.job, name, status)
+            robot.job = None
+            self._schedule()
+
+    def status(self):
+        with self.lock:
+            return {
+                'robots': {name: {'place': robot.place, 'job': robot.job.ticket if robot.job else None, 'jobs': robot.jobs}
+                           for name, robot in self.robots.items()},
+                'queued': len(self.jobs),
+                'windows': len(self.windows),
+                'reservations': self.reservations,
+                'waits': self.waits,
+                'moves': self.moves
+            }
+
+    def _park(self, robot, place, now):
+        self.windows = [window for window in self.windows if not (window.robot == robot.name and window.end > now)]
+        robot.place = place if place in self.places else None
+        if robot.place is not None:
+            self.windows.append(Window(robot.name, (self._point(robot.place),) * 2, now))
+
+    def _point(self, place):
+        x, y = self.places[place][:2]
+        return (x, y)
+
+    def _makeWay(self, name, shapes):
+        # Must be called with the lock held, sends an idle robot to the closest place clear of the shapes and of the parked robots
+        robot = self.robots.get(name)
+        if robot is None or robot.job is not None or robot.place is None:
+            return
+        parked = [window.shape for window in self.windows if window.robot != name and window.end == math.inf]
+        free = [place for place in self.places if place != robot.place
+                and all(segmentDistance((self._point(place),) * 2, shape) >= self.clearance for shape in shapes + parked)]
+        if not free:
+            return
+        place = min(free, key=lambda place: self._distance(robot.place, place))
+        print('Robot {} makes way, from {} to {}'.format(name, robot.place, place))
+        self.tickets += 1
+        self.moves += 1
+        self._dispatch(robot, Job(self.tickets, {'type': 'goSomewhere', 'place': place, 'speed': MAKE_WAY_SPEED}, name, None))
+
+    def _distance(self, fromPlace, toPlace):
+        if fromPlace is None:
+            return math.inf
+        (fromX, fromY), (toX, toY) = self._point(fromPlace), self._point(toPlace)
+        return math.hypot(toX - fromX, toY - fromY)
+
+    def _schedule(self):
+        # Must be called with the lock held
+        for job in list(self.jobs):
+            idle = [robot for robot in self.robots.values() if robot.job is None
+                    and (job.robot is None or robot.name == job.robot)]
+            if not idle:
+                continue
+            place = job.payload.get('place')
+            if place in self.places:
+                # The idle robot closest to the place gets the job, a robot at an unknown place goes last
+                robot = min(idle, key=lambda robot: self._distance(robot.place, place))
+            else:
+                robot = idle[0]
+            self.jobs.remove(job)
+            self._dispatch(robot, job)
+
+    def _dispatch(self, robot, job):
+        robot.job = job
+        robot.jobs += 1
+        job.startedAt = time.monotonic()
+        robot.connection.send({'op': 'directive', 'ticket': job.ticket, 'payload': job.payload})
+
+    def _reply(self, job, robot, status):
+        if job.connection is None:
+            # Sent by the coordinator itself
+            return
+        now = time.monotonic()
+        job.connection.send({'op': 'result', 'ticket': job.ticket, 'robot': robot, 'status': status,
+                             'wait': round(job.startedAt - job.submittedAt, 3), 'run': round(now - job.startedAt, 3)})
+
+
+class Connection(socketserver.StreamRequestHandler):
+    '''
+    One gadget or controller connected to the coordinator. Messages are JSON objects, one per line.
+    '''
+
+    def setup(self):
+        super().setup()
+        self.lock = threading.Lock()
+        self.robot = None
+
+    def send(self, message):
+        try:
+            with self.lock:
+                self.wfile.write((json.dumps(message) + '\n').encode('utf-8'))
+                self.wfile.flush()
+        except (IOError, OSError):
+            pass
+
+    def handle(self):
+        coordinator = self.server.coordinator
+        try:
+            for line in self.rfile:
+                try:
+                    message = json.loads(line.decode('utf-8'))
+                    self.dispatch(coordinator, message)
+                except (KeyError, ValueError, TypeError) as error:
+                    self.send({'op': 'error', 'error': 'invalid message ({}): {}'.format(error, line[:200])})
+        finally:
+            if self.robot is not None:
+                coordinator.leave(self.robot, self)
+
+    def dispatch(self, coordinator, message):
+        op = message['op']
+        if op == 'hello':
+            error = coordinator.join(message['robot'], self, message)
+            if error is not None:
+                self.send({'op': 'error', 'error': error})
+                return
+            self.robot = message['robot']
+        elif op == 'reserve':
+            delay, blocker = coordinator.reserve(self.robot, [tuple(leg) for leg in message['trip']])
+            self.send({'op': 'reservation', 'id': message['id'], 'ok': delay is not None,
+                       'start': delay, 'blockedBy': blocker})
+        elif op == 'arrived':
+            coordinator.arrived(self.robot, message['place'])
+        elif op == 'finished':
+            coordinator.finished(self.robot, message['ticket'], message['status'])
+        elif op == 'submit':
+            ticket = coordinator.submit(message['payload'], message.get('robot'), self)
+            self.send({'op': 'submitted', 'id': message.get('id'), 'ticket': ticket})
+        elif op == 'status':
+            self.send(dict(coordinator.status(), op='status'))
+        else:
+            self.send({'op': 'error', 'error': 'unknown op {}'.format(op)})
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, coordinator):
+        if os.path.exists(path):
+            os.unlink(path)
+        super().__init__(path, Connection)
+        self.coordinator = coordinator
+
+
+class Controller(object):
+    '''
+    Client submitting directives to the fleet and collecting their results.
+    '''
+
+    def __init__(self, path=FLEET_SOCKET):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(path)
+        self.reader = self.socket.makefile('rb')
+        # Results received while waiting for another reply
+        self.received = deque()
+
+    def send(self, message):
+        self.socket.sendall((json.dumps(message) + '\n').encode('utf-8'))
+
+    def receive(self):
+        line = self.reader.readline()
+        if not line:
+            raise EOFError('the coordinator closed the connection')
+        return json.loads(line.decode('utf-8'))
+
+    def request(self, message, reply):
+        self.send(message)
+        while True:
+            message = self.receive()
+            if message['op'] == reply:
+                return message
+            if message['op'] == 'result':
+                self.received.append(message)
+
+    def submit(self, payload, robot=None):
+        return self.request({'op': 'submit', 'payload': payload, 'robot': robot}, 'submitted')['ticket']
+
+    def results(self, count):
+        results = []
+        while len(results) < count:
+            message = self.received.popleft() if self.received else self.receive()
+            if message['op'] == 'result':
+                results.append(message)
+        return results
+
+    def status(self):
+        return self.request({'op': 'status'}, 'status')
+
+    def close(self):
+        self.socket.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Coordinates several gadgets driving on the same field')
+    parser.add_argument('--socket', default=FLEET_SOCKET, help='unix socket the gadgets connect to')
+    parser.add_argument('--clearance', type=float, default=ROBOT_CLEARANCE, help='milimiters kept between two robots')
+    parser.add_argument('--submit', help='JSON payload of a directive to submit to a running coordinator')
+    parser.add_argument('--robot', help='robot to submit the directive to, the most suitable idle one by default')
+    args = parser.parse_args()
+
+    if args.submit:
+        controller = Controller(args.socket)
+        controller.submit(json.loads(args.submit), args.robot)
+        print(controller.results(1)[0])
+        controller.close()
+        return 0
+
+    server = Server(args.socket, Coordinator(args.clearance))
+    print('Coordinator listening on {}'.format(args.socket))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
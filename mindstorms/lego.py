@@ -1,10 +1,26 @@
 
 import time
+# Start of the startup, the time spent in the imports below is the first startup phase
+STARTED_AT = time.monotonic()
+
 import logging
 import json
 import random
+import itertools
+import signal
 import threading
 import math
+import os
+import io
+import queue
+import socket
+import wave
+import subprocess
+import struct
+import mmap
+import zlib
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from time import sleep
 
@@ -15,13 +31,132 @@ from ev3dev2.sound import Sound
 from ev3dev2.motor import LargeMotor, OUTPUT_A, OUTPUT_B, OUTPUT_C, MoveTank, SpeedPercent, MediumMotor
 from ev3dev2.sensor.lego import InfraredSensor, ColorSensor, TouchSensor
 
-from ev3dev2.display import *
+# ev3dev2.display and PIL are slow to import on the EV3, they are imported when the display is opened
 
-from PIL import Image
+try:
+    import audioop
+except ImportError:
+    # Without audioop the phrases cannot be converted to the format of the sound files, they are spoken by espeak
+    audioop = None
 
 # Set the logging level to INFO to see messages from AlexaGadget
 logging.basicConfig(level=logging.INFO)
 
+# Control types executed by the motion worker, they can be preempted by a newer directive
+MOTION_CONTROLS = ('goSomewhere', 'findColor', 'useTool', 'moveRemote', 'sequence')
+
+# Control types that can be a step of a sequence
+SEQUENCE_CONTROLS = ('goSomewhere', 'setTarget', 'changeTool', 'useTool', 'findColor', 'setSpeed', 'moveRemote')
+
+# Parameters each control type needs in its payload
+CONTROL_PARAMETERS = {
+    'changeTool': ('tool',),
+    'useTool': ('tool',),
+    'goSomewhere': ('place', 'speed'),
+    'findColor': ('color', 'speed'),
+    'setSpeed': ('speed',),
+    'setTarget': ('target',),
+    'moveRemote': ('direction',),
+    'sequence': ('steps',)
+}
+
+# Colors the color sensor names, the ones findColor can look for, and the directions of the remote moves
+COLORS = ('Black', 'Blue', 'Green', 'Yellow', 'Red', 'White', 'Brown')
+REMOTE_DIRECTIONS = ('forward', 'backward', 'left', 'right')
+
+# Time in milliseconds given to the motors to report they are running after a move is started
+WAIT_RUNNING_TIMEOUT = 100
+
+# Cost of turning one radian in place, in milimiters of straight driving, used to score routes
+TURN_COST = 150.0
+
+# Largest heading error, in radians, that a trajectory absorbs with an arc instead of turning in place first
+MAX_ARC_ANGLE = math.pi/4
+
+# Degrees before the end of a trajectory segment at which the next segment is started
+SEGMENT_TOLERANCE = 5
+
+# Distance in milimiters from a place within which the robot counts as being at it
+PLACE_TOLERANCE = 30
+
+# Color sensor sampling rate in Hz, and how many of the last samples must agree to report a color
+COLOR_SAMPLE_RATE = 20
+COLOR_WINDOW = 5
+COLOR_VOTES = 3
+
+# File where the positions of the colors along the colors line are kept, and the distance in milimiters
+# scanned on each side of a known position to confirm the color is still there
+COLOR_INDEX_FILE = './colorIndex.json'
+COLOR_CONFIRM_MARGIN = 60.0
+
+# Colors seen between the tiles of the colors line, the floor of the field and nothing at all, never indexed
+COLOR_UNINDEXED = ('NoColor', 'White')
+
+# Polling periods in seconds of the infrared remote and the touch sensor
+IR_POLL_PERIOD = 0.05
+TOUCH_POLL_PERIOD = 0.05
+
+# Fixed phrases rendered to PCM at startup so speaking them does not run espeak on the critical path
+SOUND_PHRASES = ('Lego robot, ready for action', 'That color is here')
+
+# Beacon pursuit: sampling period in seconds, weight of a new sample in the filter, steering gain per radian of
+# heading, seconds without seeing the beacon before giving up and longest pursuit
+BEACON_PERIOD = 0.05
+BEACON_SMOOTHING = 0.5
+BEACON_GAIN = 1.5
+BEACON_LOST_TIMEOUT = 1.0
+BEACON_TIMEOUT = 20.0
+
+# Settings and flags of the robot shared by the threads of the gadget, with their values at startup
+ROBOT_STATE_DEFAULTS = OrderedDict([
+    ('speed', 50),
+    ('tool', 'gun'),
+    ('toolStates', None),
+    ('target', 'none'),
+    ('fromPlace', 'home'),
+    ('toPlace', 'home'),
+    ('color', ''),
+    ('remoteDirection', 'forward'),
+    ('remoteControl', False),
+    ('findColorOn', False),
+    ('colorFound', False),
+    ('beacon', False)
+])
+
+# Unix socket of the fleet coordinator (coordinator.py), the gadget joins the fleet when it is there
+FLEET_SOCKET = '/tmp/lego-fleet.sock'
+# Margin on the trip durations reserved on the field, weight of the last trip in the measured pace, seconds to
+# wait for the coordinator to answer, between two requests while the field is blocked and before giving up
+FLEET_TIME_MARGIN = 1.25
+FLEET_PACE_SMOOTHING = 0.5
+FLEET_REPLY_TIMEOUT = 2.0
+FLEET_RETRY = 0.2
+FLEET_WAIT_TIMEOUT = 60.0
+
+# Spans kept by the tracer, the oldest ones are dropped first, and file the trace is dumped to.
+# Tracing is switched on and off with SIGUSR1 and dumped with SIGUSR2, along with the worker counters, e.g. kill -USR1 <pid>
+TRACE_CAPACITY = 4096
+TRACE_FILE = './trace.json'
+
+# Most times per second the HUD widgets are redrawn, and the boxes of the widgets on the bottom rows of the LCD
+HUD_FRAME_RATE = 5
+HUD_WIDGETS = {
+    'speed': (0, 117, 28, 128),
+    'tool': (28, 117, 72, 128),
+    'color': (72, 117, 118, 128),
+    'pose': (118, 117, 178, 128)
+}
+
+# Memory mapped file keeping the state of the robot across restarts, and how often the pose is saved in it
+STATE_FILE = './state.bin'
+STATE_PERIOD = 1.0
+
+# Period in seconds at which the wheel encoders are integrated into the robot pose
+ODOMETRY_PERIOD = 0.02
+
+# Immutable robot pose published by the odometry, timestamp is the time.monotonic() of the encoder reading
+Pose = namedtuple('Pose', ['x', 'y', 'orientation', 'timestamp'])
+
 class EventName(Enum):
     """
     The list of custom event name sent from this gadget
@@ -31,6 +166,1532 @@ class EventName(Enum):
     FINDCOLOR = "FindColor"
     REMOTECONTROL = "RemoteControl"
     HOMEBUTTON = "HomeButton"
+    SEQUENCE = "Sequence"
+
+
+# Events that the steps of a sequence do not send, they are reported together when the sequence ends
+SEQUENCE_EVENTS = (EventName.SETSPEED, EventName.SETTARGET, EventName.FINDCOLOR)
+
+# Events of which only the latest pending one is sent, the newer payload replaces the older one
+COALESCED_EVENTS = (EventName.SETSPEED, EventName.SETTARGET, EventName.REMOTECONTROL, EventName.HOMEBUTTON)
+
+# Minimum time in seconds between two events of the given name, and between any two events
+EVENT_INTERVALS = {EventName.REMOTECONTROL: 1.0}
+EVENT_MIN_INTERVAL = 0.05
+
+
+class ImageCache(object):
+    '''
+    Bounded LRU cache of the BMP assets already decoded into the LCD pixel mode,
+    so showing an image never touches the SD card once it has been loaded. The mode is set
+    by the display worker once the display is open.
+    '''
+
+    def __init__(self, directory, mode=None, capacity=96):
+        self.directory = directory
+        self.mode = mode
+        self.capacity = capacity
+        self.images = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def preload(self):
+        # Decode every asset up front (up to the cache capacity) so the first directive does not pay for it
+        names = sorted(name for name in os.listdir(self.directory) if name.lower().endswith('.bmp'))
+        for name in names[:self.capacity]:
+            self.get(name)
+        return len(self.images)
+
+    def get(self, image_name):
+        with self.lock:
+            image = self.images.get(image_name)
+            if image is not None:
+                self.images.move_to_end(image_name)
+                self.hits += 1
+                return image
+            self.misses += 1
+
+        image = self._decode(image_name)
+
+        with self.lock:
+            self.images[image_name] = image
+            self.images.move_to_end(image_name)
+            while len(self.images) > self.capacity:
+                self.images.popitem(last=False)
+                self.evictions += 1
+        return image
+
+    def _decode(self, image_name):
+        from PIL import Image
+        image = Image.open(os.path.join(self.directory, image_name))
+        image.load()
+        if image.mode != self.mode:
+            image = image.convert(self.mode)
+        return image
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.images), 'capacity': self.capacity, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+
+class Widget(object):
+    '''
+    Text field of the HUD drawn in a fixed box (left, top, right, bottom) of the LCD.
+    The text is read from source on every HUD frame and the box is only redrawn when it changes.
+    '''
+
+    def __init__(self, name, box, source):
+        self.name = name
+        self.box = box
+        self.source = source
+        self.text = None
+
+
+class DisplayWorker(object):
+    '''
+    Draws queued frames on the LCD from its own thread and takes care of the hold time
+    of each frame, so callers of show_image return immediately. The display is opened by that
+    thread too, the frames shown before it is open wait in the queue.
+    The HUD widgets are composited over every frame, and in between frames the boxes of the widgets
+    whose text changed are redrawn and only their rows are written to the framebuffer, at most
+    frameRate times per second.
+    '''
+
+    def __init__(self, opener, cache, maxFrames=16, frameRate=HUD_FRAME_RATE):
+        self.opener = opener
+        self.lcd = None
+        self.openTime = None
+        self.cache = cache
+        self.frames = queue.Queue(maxFrames)
+        self.period = 1.0 / frameRate
+        self.widgets = []
+        self.dropped = 0
+        self.fullUpdates = 0
+        self.partialUpdates = 0
+        self.rowsWritten = 0
+        self.updateTime = 0.0
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def addWidget(self, name, box, source):
+        self.widgets.append(Widget(name, box, source))
+
+    def show(self, image_name, hold=0):
+        frame = (image_name, hold)
+        while True:
+            try:
+                self.frames.put_nowait(frame)
+                return
+            except queue.Full:
+                # Drop the oldest pending frame, the newest one is always the most relevant
+                try:
+                    self.frames.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def pending(self):
+        return self.frames.qsize()
+
+    def stats(self):
+        updates = self.fullUpdates + self.partialUpdates
+        return {'full': self.fullUpdates, 'partial': self.partialUpdates, 'rows': self.rowsWritten,
+                'dropped': self.dropped, 'update': round(self.updateTime / updates, 4) if updates else None,
+                'open': round(self.openTime, 3) if self.openTime is not None else None}
+
+    def _open(self):
+        started = time.monotonic()
+        try:
+            self.lcd = self.opener()
+        except (IOError, OSError, ImportError) as error:
+            print('Cannot open the display: {}'.format(error))
+            return False
+        self.cache.mode = self.lcd.image.mode
+        self.openTime = time.monotonic() - started
+        print('Display opened in {:.2f}s'.format(self.openTime))
+        # Decode the images in the background, the queued frames are decoded first when they are shown
+        threading.Thread(target=self.cache.preload, daemon=True).start()
+        return True
+
+    def _run(self):
+        if not self._open():
+            return
+        holdUntil = 0.0
+        while True:
+            now = time.monotonic()
+            if now >= holdUntil:
+                try:
+                    image_name, hold = self.frames.get(timeout=self.period)
+                except queue.Empty:
+                    pass
+                else:
+                    if self._show_frame(image_name):
+                        holdUntil = time.monotonic() + hold
+                    continue
+            else:
+                # The frame is held, the HUD keeps being refreshed over it
+                sleep(min(self.period, holdUntil - now))
+            self._refresh()
+
+    def _show_frame(self, image_name):
+        try:
+            self.lcd.image.paste(self.cache.get(image_name), (0,0))
+            for widget in list(self.widgets):
+                self._draw_widget(widget, widget.source())
+            started = time.monotonic()
+            self.lcd.update()
+        except (IOError, OSError) as error:
+            print('Cannot show image {}: {}'.format(image_name, error))
+            return False
+        self.fullUpdates += 1
+        self.updateTime += time.monotonic() - started
+        return True
+
+    def _refresh(self):
+        # Redraws the widgets whose text changed and writes only the rows they cover
+        boxes = []
+        for widget in list(self.widgets):
+            text = widget.source()
+            if text != widget.text:
+                self._draw_widget(widget, text)
+                boxes.append(widget.box)
+        if boxes:
+            started = time.monotonic()
+            try:
+                self._update_rows(boxes)
+            except (IOError, OSError) as error:
+                print('Cannot update the HUD: {}'.format(error))
+                return
+            self.partialUpdates += 1
+            self.updateTime += time.monotonic() - started
+
+    def _draw_widget(self, widget, text):
+        from PIL import Image, ImageDraw
+        left, top, right, bottom = widget.box
+        # Drawn on its own patch so a long text never spills over the next widget
+        patch = Image.new(self.lcd.image.mode, (right - left, bottom - top), 'white')
+        ImageDraw.Draw(patch).text((1, 0), text, fill='black')
+        self.lcd.image.paste(patch, (left, top))
+        widget.text = text
+
+    def _update_rows(self, boxes):
+        # Merges the boxes into bands of rows, the framebuffer lines are contiguous so a band is a single write
+        bands = []
+        for top, bottom in sorted((box[1], box[3]) for box in boxes):
+            if bands and top <= bands[-1][1]:
+                bands[-1][1] = max(bands[-1][1], bottom)
+            else:
+                bands.append([top, bottom])
+
+        lcd = self.lcd
+        bits = getattr(getattr(lcd, 'var_info', None), 'bits_per_pixel', None)
+        if bits not in (1, 32) or getattr(lcd, 'mmap', None) is None:
+            # Same conversion as Display.update for these modes, any other one is pushed whole
+            lcd.update()
+            self.rowsWritten += lcd.image.size[1]
+            return
+        lineLength = lcd.fix_info.line_length
+        width = lcd.image.size[0]
+        for top, bottom in bands:
+            band = lcd.image.crop((0, top, width, bottom))
+            data = band.tobytes('raw', '1;R') if bits == 1 else band.convert('RGB').tobytes('raw', 'XRGB')
+            lcd.mmap[top * lineLength:top * lineLength + len(data)] = data
+            self.rowsWritten += bottom - top
+
+
+class AudioPlayer(object):
+    '''
+    Plays the sound files and the spoken phrases from memory through a single long-lived aplay process,
+    fed from a queue by its own thread, so callers of play_file and speak never wait for the sound.
+    All the clips are kept in the format of the WAV files in the sounds directory.
+    '''
+
+    def __init__(self, sound, directory, phrases=(), maxClips=16):
+        self.sound = sound
+        self.directory = directory
+        self.phrases = phrases
+        self.clips = {}
+        self.format = None
+        self.process = None
+        self.clipQueue = queue.Queue(maxClips)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.dropped = 0
+        self.latencies = deque(maxlen=32)
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def play_file(self, path):
+        with TRACER.span('play_file', clip=os.path.basename(path)):
+            self._enqueue(('file', os.path.basename(path), time.monotonic(), TRACER.directive()))
+
+    def speak(self, text):
+        with TRACER.span('speak', clip=text):
+            self._enqueue(('speak', text, time.monotonic(), TRACER.directive()))
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {'clips': len(self.clips), 'hits': self.hits, 'misses': self.misses,
+                    'hitRate': round(self.hits / requests, 3) if requests else None,
+                    'latency': round(sum(self.latencies) / len(self.latencies), 3) if self.latencies else None,
+                    'dropped': self.dropped}
+
+    def _enqueue(self, clip):
+        try:
+            self.clipQueue.put_nowait(clip)
+        except queue.Full:
+            # A sound that late is not worth playing
+            with self.lock:
+                self.dropped += 1
+
+    def _preload(self):
+        for name in sorted(os.listdir(self.directory)):
+            if name.lower().endswith('.wav'):
+                self._load(('file', name))
+        for text in self.phrases:
+            self._load(('speak', text))
+
+    def _load(self, key):
+        kind, name = key
+        try:
+            if kind == 'file':
+                with open(os.path.join(self.directory, name), 'rb') as wav:
+                    clip = self._decode(wav.read())
+            else:
+                clip = self._render(name)
+        except (IOError, OSError, wave.Error) as error:
+            print('Cannot load sound {}: {}'.format(name, error))
+            clip = None
+        if clip is not None:
+            with self.lock:
+                self.clips[key] = clip
+        return clip
+
+    def _decode(self, data):
+        # Returns the PCM frames of a WAV file converted to the player format, the first file decoded sets the format
+        with wave.open(io.BytesIO(data)) as wav:
+            channels, width, rate = wav.getnchannels(), wav.getsampwidth(), wav.getframerate()
+            frames = wav.readframes(wav.getnframes())
+        if self.format is None:
+            self.format = (channels, width, rate)
+        if (channels, width, rate) == self.format:
+            return frames
+        if audioop is None:
+            return None
+        targetChannels, targetWidth, targetRate = self.format
+        if width != targetWidth:
+            frames = audioop.lin2lin(frames, width, targetWidth)
+        if channels == 2 and targetChannels == 1:
+            frames = audioop.tomono(frames, targetWidth, 0.5, 0.5)
+        elif channels == 1 and targetChannels == 2:
+            frames = audioop.tostereo(frames, targetWidth, 1, 1)
+        if rate != targetRate:
+            frames, _ = audioop.ratecv(frames, targetWidth, targetChannels, rate, targetRate, None)
+        return frames
+
+    def _render(self, text):
+        # Same voice options as ev3dev2 Sound.speak
+        data = subprocess.check_output(['/usr/bin/espeak', '--stdout', '-a', '200', '-s', '130', text],
+                                       stderr=subprocess.DEVNULL)
+        return self._decode(data)
+
+    def _output(self):
+        if self.process is None or self.process.poll() is not None:
+            channels, width, rate = self.format
+            self.process = subprocess.Popen(
+                ['/usr/bin/aplay', '-q', '-t', 'raw', '-f', 'S{}_LE'.format(8 * width), '-r', str(rate), '-c', str(channels)],
+                stdin=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        return self.process.stdin
+
+    def _run(self):
+        self._preload()
+        while True:
+            kind, name, queuedAt, directive = self.clipQueue.get()
+            with self.lock:
+                clip = self.clips.get((kind, name))
+                if clip is not None:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+            if clip is None:
+                clip = self._load((kind, name))
+            if clip is None:
+                # Cannot be converted to the player format, fall back to the ev3dev player
+                if kind == 'speak':
+                    self.sound.speak(name)
+                else:
+                    self.sound.play_file(os.path.join(self.directory, name))
+                continue
+            with self.lock:
+                self.latencies.append(time.monotonic() - queuedAt)
+            try:
+                with TRACER.span('sound', directive, clip=name):
+                    output = self._output()
+                    output.write(clip)
+                    output.flush()
+            except (IOError, OSError) as error:
+                print('Cannot play sound {}: {}'.format(name, error))
+                self.process = None
+
+
+class EventSender(object):
+    '''
+    Sends the custom events from its own thread. Posting never blocks: pending events of a coalesced
+    name are merged, the oldest event is dropped when the queue is full, and the sender keeps the
+    minimum interval between events so the Bluetooth link is not flooded.
+    '''
+
+    def __init__(self, send, maxEvents=16, intervals=EVENT_INTERVALS, minInterval=EVENT_MIN_INTERVAL):
+        self.send = send
+        self.maxEvents = maxEvents
+        self.intervals = intervals
+        self.minInterval = minInterval
+        self.pending = OrderedDict()
+        self.lastSent = {}
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self.sent = 0
+        self.merged = 0
+        self.dropped = 0
+        self.latencies = deque(maxlen=32)
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def post(self, name, payload):
+        with self.condition:
+            if name in COALESCED_EVENTS:
+                key = name
+            else:
+                self.sequence += 1
+                key = (name, self.sequence)
+            if key in self.pending:
+                # Keep the place in the queue and the time of the first event, with the latest payload
+                queuedAt = self.pending[key][2]
+                self.pending[key] = (name, payload, queuedAt)
+                self.merged += 1
+                return
+            if len(self.pending) >= self.maxEvents:
+                self.pending.popitem(last=False)
+                self.dropped += 1
+            self.pending[key] = (name, payload, time.monotonic())
+            self.condition.notify()
+
+    def stats(self):
+        with self.condition:
+            return {'pending': len(self.pending), 'sent': self.sent, 'merged': self.merged, 'dropped': self.dropped,
+                    'latency': round(sum(self.latencies) / len(self.latencies), 3) if self.latencies else None}
+
+    def _next(self):
+        # Must be called with the condition held, returns the first event allowed to go now or the time to wait for one
+        now = time.monotonic()
+        wait = None
+        for key, (name, payload, queuedAt) in self.pending.items():
+            ready = self.lastSent.get(name, -math.inf) + self.intervals.get(name, 0.0)
+            if ready <= now:
+                del self.pending[key]
+                self.lastSent[name] = now
+                return (name, payload, queuedAt), None
+            wait = ready - now if wait is None else min(wait, ready - now)
+        return None, wait
+
+    def _run(self):
+        while True:
+            with self.condition:
+                event, wait = self._next()
+                while event is None:
+                    self.condition.wait(wait)
+                    event, wait = self._next()
+            name, payload, queuedAt = event
+            try:
+                self.send(name, payload)
+            except Exception as error:
+                print('Cannot send event {}: {}'.format(name.value, error))
+            with self.condition:
+                self.sent += 1
+                self.latencies.append(time.monotonic() - queuedAt)
+            sleep(self.minInterval)
+
+
+class Tool(object):
+    '''
+    A weapon of the robot: how far from the target the robot stops, the (speed, degrees) moves of the
+    weapon and how many milimiters before the end of the approach they start. Tools with states, like
+    the picker, have the moves of each state and the state they leave the tool in.
+    '''
+
+    def __init__(self, name, offset, steps=(), states=None, initialState=None, lead=0.0):
+        '''
+        :param offset: distance to the target where the approach ends, None to use the tool from where the robot is
+        :param steps: the weapon moves, for tools without states
+        :param states: state -> (moves, next state), for tools with states
+        :param lead: distance before the end of the approach at which the weapon starts moving
+        '''
+        self.name = name
+        self.offset = offset
+        self.steps = steps
+        self.states = states
+        self.initialState = initialState
+        self.lead = lead
+
+    def approachOffset(self, distance):
+        return distance if self.offset is None else self.offset
+
+    def actions(self, state):
+        # Returns the weapon moves to make in the given state and the state they leave the tool in
+        if self.states is None:
+            return self.steps, state
+        return self.states[state]
+
+
+# The tools the robot can use, a new tool only needs an entry here
+TOOLS = {tool.name: tool for tool in (
+    Tool('gun', None, steps=((100, 1000),)),
+    Tool('hammer', 130, steps=((100, 200), (-50, 200))),
+    # The picker closes when it is open to pick and opens when it holds something to leave
+    Tool('picker', 80, states={'pick': (((100, 90),), 'leave'), 'leave': (((-100, 90),), 'pick')}, initialState='pick'),
+    # The blade spins up while the robot is still driving in
+    Tool('blade', 80, steps=((100, 360), (-100, 360)), lead=100.0)
+)}
+
+
+class StartupTimer(object):
+    '''
+    Records how long each startup phase takes, so a slower startup shows in the log.
+    '''
+
+    def __init__(self, startedAt):
+        self.startedAt = startedAt
+        self.last = startedAt
+        self.phases = []
+
+    def mark(self, phase):
+        now = time.monotonic()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def total(self):
+        return self.last - self.startedAt
+
+    def report(self):
+        return 'Ready in {:.2f}s: {}'.format(
+            self.total(), ', '.join('{} {:.2f}s'.format(phase, duration) for phase, duration in self.phases))
+
+
+class Span(object):
+    '''
+    Timed section of the code recorded by the tracer when it ends.
+    '''
+    __slots__ = ('tracer', 'name', 'directive', 'args', 'start')
+
+    def __init__(self, tracer, name, directive, args):
+        self.tracer = tracer
+        self.name = name
+        self.directive = directive
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *error):
+        self.tracer.record(self.name, self.directive, self.start, time.monotonic(), self.args)
+        return False
+
+
+class NullSpan(object):
+    '''
+    Span returned while the tracer is off, it records nothing.
+    '''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *error):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer(object):
+    '''
+    Keeps the spans of the directive to motion to event path in a ring buffer, each one tagged with the
+    directive it belongs to. It is off by default, then a span costs a single attribute check.
+    The spans are dumped in the Chrome trace format (chrome://tracing) or summed up as latency histograms.
+    '''
+
+    def __init__(self, capacity=TRACE_CAPACITY):
+        self.enabled = False
+        self.spans = deque(maxlen=capacity)
+        self.local = threading.local()
+        self.directives = itertools.count(1)
+        self.origin = time.monotonic()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+        print('Tracing {}'.format('on' if enabled else 'off'))
+
+    def newDirective(self):
+        # Numbers a received directive, the spans of the calling thread are tagged with it from now on
+        directive = next(self.directives)
+        self.local.directive = directive
+        return directive
+
+    def setDirective(self, directive):
+        self.local.directive = directive
+
+    def directive(self):
+        return getattr(self.local, 'directive', None)
+
+    def span(self, name, directive=None, **args):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, directive if directive is not None else self.directive(), args)
+
+    def record(self, name, directive, start, end, args):
+        self.spans.append((name, directive, threading.current_thread().name, start, end - start, args))
+
+    def chromeTrace(self):
+        events = []
+        for name, directive, thread, start, duration, args in list(self.spans):
+            eventArgs = dict(args, directive=directive)
+            events.append({'name': name, 'cat': 'lego', 'ph': 'X', 'pid': os.getpid(), 'tid': thread,
+                           'ts': round((start - self.origin) * 1e6, 1), 'dur': round(duration * 1e6, 1),
+                           'args': eventArgs})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def histograms(self):
+        # Durations of every span name in milliseconds, counted in power of two buckets
+        durations = {}
+        for name, directive, thread, start, duration, args in list(self.spans):
+            durations.setdefault(name, []).append(duration * 1000)
+        histograms = {}
+        for name, values in sorted(durations.items()):
+            values.sort()
+            buckets = OrderedDict()
+            for value in values:
+                bound = 2 ** max(-4, math.ceil(math.log2(value))) if value > 0 else 2 ** -4
+                key = '<={:g}ms'.format(bound)
+                buckets[key] = buckets.get(key, 0) + 1
+            histograms[name] = {'count': len(values), 'p50': round(values[len(values) // 2], 3),
+                                'p95': round(values[min(len(values) - 1, int(0.95 * len(values)))], 3),
+                                'max': round(values[-1], 3), 'buckets': buckets}
+        return histograms
+
+    def dump(self, path=TRACE_FILE):
+        with open(path, 'w') as trace:
+            json.dump(self.chromeTrace(), trace)
+        return len(self.spans)
+
+
+# Tracer shared by every part of the gadget
+TRACER = Tracer()
+
+
+class TracedMotor(object):
+    '''
+    Motor or motor pair whose on_for_degrees calls are traced, everything else goes to the motor as is.
+    '''
+
+    def __init__(self, motor, name):
+        self.motor = motor
+        self.name = name
+
+    def on_for_degrees(self, *args, **kwargs):
+        with TRACER.span('on_for_degrees', motor=self.name, block=kwargs.get('block', True)):
+            return self.motor.on_for_degrees(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.motor, name)
+
+
+class CommandPreempted(Exception):
+    '''
+    Raised inside a running command when a newer directive or a stop cancels it.
+    '''
+
+
+class CommandFailed(Exception):
+    '''
+    Raised inside a running command when it cannot do what it was asked, so it is reported as failed.
+    '''
+
+
+class Command(object):
+    '''
+    A parsed control directive, with the timestamps used to report its wait and run times.
+    '''
+
+    def __init__(self, name, payload):
+        self.name = name
+        self.payload = payload
+        self.steps = []
+        self.directive = None
+        self.ticket = None
+        self.cancelled = threading.Event()
+        # Shared by a sequence and its steps, the events of the steps are gathered in it instead of being sent
+        self.results = None
+        self.status = 'queued'
+        self.queuedAt = time.monotonic()
+        self.startedAt = None
+        self.finishedAt = None
+
+    def check(self):
+        # Raise if the command has been preempted, used between the steps of a long command
+        if self.cancelled.is_set():
+            raise CommandPreempted(self.name)
+
+    def sleep(self, seconds):
+        # Interruptible replacement of time.sleep for code running inside a command
+        if self.cancelled.wait(seconds):
+            raise CommandPreempted(self.name)
+
+    def waitTime(self):
+        return (self.startedAt or time.monotonic()) - self.queuedAt
+
+    def runTime(self):
+        if self.startedAt is None:
+            return 0.0
+        return (self.finishedAt or time.monotonic()) - self.startedAt
+
+
+class MotionExecutor(object):
+    '''
+    Runs motion commands one at a time in a dedicated worker thread. Submitting a new command
+    preempts the running one and drops the commands still waiting, so the latest directive wins.
+    '''
+
+    def __init__(self, runner, halt, finished=None, historySize=32):
+        self.runner = runner
+        self.halt = halt
+        self.finished = finished
+        self.pending = deque()
+        self.current = None
+        self.history = deque(maxlen=historySize)
+        self.condition = threading.Condition()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, command, preempt=True):
+        dropped = []
+        with self.condition:
+            preempted = self._cancel(dropped) if preempt else False
+            self.pending.append(command)
+            self.condition.notify()
+        if preempted:
+            self.halt()
+        self._notify(dropped)
+
+    def stop(self):
+        dropped = []
+        with self.condition:
+            preempted = self._cancel(dropped)
+        if preempted:
+            self.halt()
+        self._notify(dropped)
+
+    def _cancel(self, dropped):
+        # Must be called with the condition held
+        while self.pending:
+            command = self.pending.popleft()
+            command.status = 'dropped'
+            command.cancelled.set()
+            self.history.append(command)
+            dropped.append(command)
+        if self.current is not None:
+            self.current.cancelled.set()
+            return True
+        return False
+
+    def _notify(self, commands):
+        if self.finished is not None:
+            for command in commands:
+                self.finished(command)
+
+    def stats(self):
+        with self.condition:
+            return {
+                'queueDepth': len(self.pending),
+                'running': self.current.name if self.current is not None else None,
+                'history': [(command.name, command.status, round(command.waitTime(), 3), round(command.runTime(), 3))
+                            for command in self.history]
+            }
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                command = self.pending.popleft()
+                self.current = command
+            command.startedAt = time.monotonic()
+            command.status = 'running'
+            try:
+                self.runner(command)
+                command.status = 'done'
+            except CommandPreempted:
+                command.status = 'preempted'
+            except Exception as error:
+                command.status = 'failed'
+                print('Command {} failed: {}'.format(command.name, error))
+            command.finishedAt = time.monotonic()
+            with self.condition:
+                self.current = None
+                self.history.append(command)
+            print('Command {} {}: wait {:.3f}s, run {:.3f}s, queue depth {}'.format(
+                command.name, command.status, command.waitTime(), command.runTime(), len(self.pending)))
+            self._notify((command,))
+
+
+class RoutePlanner(object):
+    '''
+    Plans the trips between the places of the field. The places are the nodes of a graph whose edges are
+    the legal legs, driven forwards or backwards, and the cheapest route between every pair of places is
+    precomputed so a lookup at runtime is a single dictionary access.
+    '''
+
+    def __init__(self, places, edges, turnCost=TURN_COST):
+        '''
+        :param places: place name -> [x, y, orientation]
+        :param edges: list of (fromPlace, toPlace, mode) legs, mode being 'forward' or 'reverse'
+        :param turnCost: cost of turning one radian, in milimiters of driving
+        '''
+        self.places = places
+        self.turnCost = turnCost
+        self.legs = {}
+        for fromPlace, toPlace, mode in edges:
+            cost = self.legCost(fromPlace, toPlace, mode)
+            if cost < self.legs.get((fromPlace, toPlace), (math.inf,))[0]:
+                self.legs[(fromPlace, toPlace)] = (cost, mode)
+        self.routes = self._allPairs()
+
+    @staticmethod
+    def openField(places):
+        # Forward legs between every pair of the given places, for areas where the robot can drive straight anywhere
+        return [(a, b, 'forward') for a in places for b in places if a != b]
+
+    def legCost(self, fromPlace, toPlace, mode):
+        fromX, fromY, fromOrientation = self.places[fromPlace]
+        toX, toY, toOrientation = self.places[toPlace]
+        distance = math.hypot(toX - fromX, toY - fromY)
+        heading = math.atan2(toY - fromY, toX - fromX)
+        if mode == 'reverse':
+            heading += math.pi
+        turns = abs(normalizeAngle(heading - fromOrientation)) + abs(normalizeAngle(toOrientation - heading))
+        return distance + self.turnCost * turns
+
+    def route(self, fromPlace, toPlace):
+        '''
+        Returns the list of (place, mode) legs of the cheapest route, or None if the place cannot be reached.
+        '''
+        entry = self.routes.get((fromPlace, toPlace))
+        return entry[1] if entry is not None else None
+
+    def cost(self, fromPlace, toPlace):
+        entry = self.routes.get((fromPlace, toPlace))
+        return entry[0] if entry is not None else math.inf
+
+    def _allPairs(self):
+        # Floyd-Warshall over the few places of the field, keeping the next hop to rebuild every route
+        names = list(self.places)
+        distance = {(a, b): (0.0 if a == b else math.inf) for a in names for b in names}
+        nextHop = {}
+        for (a, b), (cost, mode) in self.legs.items():
+            distance[(a, b)] = cost
+            nextHop[(a, b)] = b
+        for k in names:
+            for a in names:
+                if distance[(a, k)] == math.inf:
+                    continue
+                for b in names:
+                    cost = distance[(a, k)] + distance[(k, b)]
+                    if cost < distance[(a, b)]:
+                        distance[(a, b)] = cost
+                        nextHop[(a, b)] = nextHop[(a, k)]
+
+        routes = {}
+        for a in names:
+            routes[(a, a)] = (0.0, [])
+            for b in names:
+                if a == b or (a, b) not in nextHop:
+                    continue
+                legs = []
+                place = a
+                while place != b:
+                    hop = nextHop[(place, b)]
+                    legs.append((hop, self.legs[(place, hop)][1]))
+                    place = hop
+                routes[(a, b)] = (distance[(a, b)], legs)
+        return routes
+
+
+class TrajectoryPlanner(object):
+    '''
+    Turns a list of waypoints into one continuous motor plan. Small heading errors are absorbed by arcs,
+    driving the two wheels at different speeds, and consecutive turns or straight stretches are merged,
+    so the robot does not stop at every intermediate place.
+    '''
+
+    def __init__(self, wheelRadius, distanceWheels, maxArcAngle=MAX_ARC_ANGLE):
+        self.wheelRadius = wheelRadius
+        self.distanceWheels = distanceWheels
+        self.maxArcAngle = maxArcAngle
+
+    def plan(self, pose, waypoints, finalOrientation=None):
+        '''
+        Returns the list of (leftDegrees, rightDegrees) segments that drive the robot through the waypoints.
+        :param pose: the (x, y, orientation) the robot starts from
+        :param waypoints: list of (x, y, reverse) points to drive through
+        :param finalOrientation: orientation to turn to at the last waypoint, None to keep the arrival heading
+        '''
+        x, y, heading = pose
+        segments = []
+        for waypointX, waypointY, reverse in waypoints:
+            distance = math.hypot(waypointX - x, waypointY - y)
+            if distance < 1.0:
+                continue
+            direction = math.atan2(waypointY - y, waypointX - x)
+            if reverse:
+                direction += math.pi
+            error = normalizeAngle(direction - heading)
+            if abs(error) > self.maxArcAngle:
+                # Too sharp for an arc, turn in place to face the waypoint first
+                self._append(segments, self._segment(0.0, error, reverse))
+                heading += error
+                error = 0.0
+            # Circular arc tangent to the current heading through the waypoint, its heading change is twice the error
+            length = distance if error == 0.0 else distance * error / math.sin(error)
+            self._append(segments, self._segment(length, 2 * error, reverse))
+            heading += 2 * error
+            x, y = waypointX, waypointY
+        if finalOrientation is not None:
+            self._append(segments, self._segment(0.0, normalizeAngle(finalOrientation - heading), False))
+        return segments
+
+    def _segment(self, length, angle, reverse):
+        # Same conventions as MindstormsGadget.turn: a positive angle runs the left wheel forwards and the right one backwards
+        travel = -length if reverse else length
+        left = travel + self.distanceWheels * angle
+        right = travel - self.distanceWheels * angle
+        toDegrees = 360 / (2 * math.pi * self.wheelRadius)
+        return (left * toDegrees, right * toDegrees)
+
+    def _append(self, segments, segment):
+        left, right = segment
+        if abs(left) < 1 and abs(right) < 1:
+            return
+        if segments:
+            # Merge with the previous segment when both wheels keep the same speed ratio
+            lastLeft, lastRight = segments[-1]
+            if abs(lastLeft * right - lastRight * left) < 1e-6 * max(abs(lastLeft * right), 1.0) and lastLeft * left >= 0 and lastRight * right >= 0:
+                segments[-1] = (lastLeft + left, lastRight + right)
+                return
+        segments.append(segment)
+
+
+class ColorSampler(object):
+    '''
+    Keeps the last color sensor samples in a ring buffer while some color is watched, and calls the
+    subscriber of a color once it wins the vote over the last samples. It is polled by the sensor
+    scheduler at COLOR_SAMPLE_RATE, and only while somebody watches a color.
+    '''
+
+    def __init__(self, sensor, window=COLOR_WINDOW, votes=COLOR_VOTES):
+        self.sensor = sensor
+        self.votes = votes
+        self.samples = deque(maxlen=window)
+        self.subscribers = {}
+        self.lock = threading.Lock()
+        self.activeSince = None
+        self.sampleCount = 0
+        self.readTime = 0.0
+        self.cpuTime = 0.0
+        self.activeTime = 0.0
+        self.reactions = deque(maxlen=32)
+        # Optional function called with every sample, used to index the colors during a sweep
+        self.recorder = None
+
+    def subscribe(self, color, callback):
+        '''
+        Calls callback(color, detectedAt) once when the color is detected, detectedAt being a time.monotonic() value.
+        '''
+        with self.lock:
+            self.subscribers[color] = callback
+            self.samples.clear()
+            if self.activeSince is None:
+                self.activeSince = time.monotonic()
+
+    def unsubscribe(self, color=None):
+        # Stops watching the given color, or every color if none is given
+        with self.lock:
+            if color is None:
+                self.subscribers.clear()
+            else:
+                self.subscribers.pop(color, None)
+            self._deactivate()
+
+    def watching(self):
+        return self.activeSince is not None
+
+    def poll(self):
+        # Takes one sample and notifies the subscriber of the color if it wins the vote
+        started = time.monotonic()
+        cpuStarted = time.clock_gettime(time.CLOCK_THREAD_CPUTIME_ID)
+        color = self.sensor.color_name # 'NoColor', 'Black', 'Blue', 'Green', 'Yellow', 'Red', 'White', 'Brown'
+        cpuTime = time.clock_gettime(time.CLOCK_THREAD_CPUTIME_ID) - cpuStarted
+        detectedAt = time.monotonic()
+
+        callback = None
+        with self.lock:
+            self.sampleCount += 1
+            self.readTime += detectedAt - started
+            self.cpuTime += cpuTime
+            self.samples.append(color)
+            if color in self.subscribers and self.samples.count(color) >= self.votes:
+                callback = self.subscribers.pop(color)
+                self._deactivate()
+        recorder = self.recorder
+        if recorder is not None:
+            recorder(color)
+        if callback is not None:
+            callback(color, detectedAt)
+
+    def _deactivate(self):
+        # Must be called with the lock held
+        if not self.subscribers and self.activeSince is not None:
+            self.activeTime += time.monotonic() - self.activeSince
+            self.activeSince = None
+
+    def stats(self):
+        with self.lock:
+            activeTime = self.activeTime
+            if self.activeSince is not None:
+                activeTime += time.monotonic() - self.activeSince
+            activeTime = activeTime or 1.0
+            return {
+                'samples': self.sampleCount,
+                'rate': round(self.sampleCount / activeTime, 1),
+                # Share of the watching time the reads take, waiting on the sensor or running on the processor
+                'busy': round(self.readTime / activeTime, 3),
+                'cpu': round(self.cpuTime / activeTime, 3),
+                'reaction': round(sum(self.reactions) / len(self.reactions), 3) if self.reactions else None
+            }
+
+
+class RobotState(object):
+    '''
+    Version of the settings and flags of the robot listed in ROBOT_STATE_DEFAULTS. A published version is
+    never modified, a change makes a copy with the next version number, so a reader holding one always
+    sees values that were set together.
+    '''
+    __slots__ = ('version',) + tuple(ROBOT_STATE_DEFAULTS)
+
+    def __init__(self, version=0, **fields):
+        unknown = set(fields) - set(ROBOT_STATE_DEFAULTS)
+        if unknown:
+            raise TypeError('Unknown robot state fields: {}'.format(', '.join(sorted(unknown))))
+        self.version = version
+        for name, default in ROBOT_STATE_DEFAULTS.items():
+            setattr(self, name, fields.get(name, default))
+
+    def replace(self, **changes):
+        fields = {name: getattr(self, name) for name in ROBOT_STATE_DEFAULTS}
+        fields.update(changes)
+        return RobotState(self.version + 1, **fields)
+
+    def __repr__(self):
+        return 'RobotState({})'.format(', '.join('{}={!r}'.format(name, getattr(self, name)) for name in self.__slots__))
+
+
+class SharedState(object):
+    '''
+    Holds the current RobotState. Reading it is a single reference read that never blocks, and a change is
+    published with compare-and-set on the version, retried when another thread changed the state first.
+    The lock is only held to swap the reference, so a writer never makes the motion loop wait.
+    '''
+
+    def __init__(self, state):
+        self.current = state
+        self.lock = threading.Lock()
+        self.retries = 0
+
+    def read(self):
+        return self.current
+
+    def compareAndSet(self, expected, **changes):
+        # Publishes the changes over the expected version, returns the new version or None if it is not the current one
+        state = expected.replace(**changes)
+        with self.lock:
+            if self.current.version != expected.version:
+                return None
+            self.current = state
+        return state
+
+    def update(self, **changes):
+        while True:
+            state = self.compareAndSet(self.current, **changes)
+            if state is not None:
+                return state
+            self.retries += 1
+
+    def setIf(self, name, expected, value):
+        # Changes a field only if it still has the expected value, returns whether this call changed it
+        while True:
+            current = self.current
+            if getattr(current, name) != expected:
+                return False
+            if self.compareAndSet(current, **{name: value}) is not None:
+                return True
+            self.retries += 1
+
+
+class StateSnapshot(object):
+    '''
+    Fixed layout record of the robot state in a memory mapped file. There are two slots written in turn,
+    each one with a sequence number and a checksum, so a crash in the middle of a write leaves the other
+    slot valid and the gadget resumes from the latest complete state.
+    '''
+
+    # magic, sequence, x, y, orientation, speed, remoteControl, fromPlace, target, tool, picker
+    LAYOUT = struct.Struct('<4sIdddh?16s16s8s8s')
+    CHECKSUM = struct.Struct('<I')
+    MAGIC = b'LGS1'
+    FIELDS = ('x', 'y', 'orientation', 'speed', 'remoteControl', 'fromPlace', 'target', 'tool', 'picker')
+
+    def __init__(self, path):
+        self.slotSize = self.LAYOUT.size + self.CHECKSUM.size
+        self.lock = threading.Lock()
+        self.sequence = 0
+        self.last = None
+        self.dirty = False
+        self.writes = 0
+        self.writeTime = 0.0
+        self.file = open(path, 'a+b')
+        if os.path.getsize(path) < 2 * self.slotSize:
+            self.file.truncate(2 * self.slotSize)
+        self.map = mmap.mmap(self.file.fileno(), 2 * self.slotSize)
+
+    def read(self):
+        # Returns the latest valid state as a dictionary, or None if there is none
+        latest = None
+        for slot in range(2):
+            record = self.map[slot * self.slotSize:(slot + 1) * self.slotSize]
+            payload, checksum = record[:self.LAYOUT.size], self.CHECKSUM.unpack(record[self.LAYOUT.size:])[0]
+            if zlib.crc32(payload) != checksum:
+                continue
+            values = self.LAYOUT.unpack(payload)
+            if values[0] != self.MAGIC or (latest is not None and values[1] <= latest[1]):
+                continue
+            latest = values
+        if latest is None:
+            return None
+        self.sequence = latest[1]
+        state = dict(zip(self.FIELDS, latest[2:]))
+        for field in ('fromPlace', 'target', 'tool', 'picker'):
+            state[field] = state[field].rstrip(b'\0').decode('utf-8')
+        state['sequence'] = latest[1]
+        return state
+
+    def write(self, state):
+        '''
+        Saves the state if it changed since the last write.
+        :param state: tuple of the values of FIELDS
+        '''
+        with self.lock:
+            if state == self.last:
+                return
+            started = time.monotonic()
+            try:
+                values = list(state)
+                for index in range(5, 9):
+                    values[index] = values[index].encode('utf-8')
+                payload = self.LAYOUT.pack(self.MAGIC, self.sequence + 1, *values)
+            except (struct.error, AttributeError, TypeError, ValueError) as error:
+                # The previous state stays the latest one, a bad value must not stop the next writes
+                print('Cannot save the state {}: {}'.format(state, error))
+                return
+            self.sequence += 1
+            slot = self.sequence % 2
+            self.map[slot * self.slotSize:(slot + 1) * self.slotSize] = payload + self.CHECKSUM.pack(zlib.crc32(payload))
+            self.last = state
+            self.dirty = True
+            self.writes += 1
+            self.writeTime += time.monotonic() - started
+
+    def flush(self):
+        # Pushes the written state to the SD card, the memory mapped writes alone survive a crash but not a power loss
+        with self.lock:
+            if self.dirty:
+                self.map.flush()
+                self.dirty = False
+
+    def stats(self):
+        with self.lock:
+            return {'sequence': self.sequence, 'writes': self.writes,
+                    'writeTime': round(self.writeTime / self.writes * 1e6, 1) if self.writes else None}
+
+
+class ColorIndex(object):
+    '''
+    Where each color is along the colors line, in milimiters from colorsLineStart. It is learnt from the
+    samples taken during the sweeps and saved to a file, so a later findColor drives straight to the color.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.positions = {}
+        self.samples = None
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as index:
+                self.positions = {color: float(position) for color, position in json.load(index).items()
+                                  if color not in COLOR_UNINDEXED}
+        except (IOError, OSError, ValueError, AttributeError):
+            self.positions = {}
+
+    def save(self):
+        # Written to a temporary file first so a crash never leaves a truncated index
+        with self.lock:
+            positions = dict(self.positions)
+        try:
+            with open(self.path + '.tmp', 'w') as index:
+                json.dump(positions, index)
+            os.replace(self.path + '.tmp', self.path)
+        except (IOError, OSError) as error:
+            print('Cannot save the color index: {}'.format(error))
+
+    def lookup(self, color):
+        with self.lock:
+            return self.positions.get(color)
+
+    def forget(self, color):
+        with self.lock:
+            self.positions.pop(color, None)
+        self.save()
+
+    def begin(self):
+        with self.lock:
+            self.samples = []
+
+    def record(self, position, color):
+        with self.lock:
+            if self.samples is not None:
+                self.samples.append((position, color))
+
+    def end(self):
+        # Each color is indexed at the middle of the longest run of samples where it was seen
+        with self.lock:
+            samples, self.samples = self.samples, None
+        if not samples:
+            return
+        runs = {}
+        first = 0
+        for index in range(1, len(samples) + 1):
+            if index == len(samples) or samples[index][1] != samples[first][1]:
+                color = samples[first][1]
+                length = index - first
+                if color not in COLOR_UNINDEXED and length > runs.get(color, (0, 0.0))[0]:
+                    runs[color] = (length, (samples[first][0] + samples[index - 1][0]) / 2)
+                first = index
+        with self.lock:
+            self.positions.update({color: round(position, 1) for color, (length, position) in runs.items()})
+        self.save()
+        print('Color index: {}'.format(self.positions))
+
+
+class BeaconTracker(object):
+    '''
+    Samples the heading and distance of the IR beacon while a pursuit is running and smooths them with an
+    exponential filter. The latest (heading, distance, timestamp) estimate, in radians and milimiters,
+    is published as an immutable tuple for the pursuit loop.
+    '''
+
+    def __init__(self, ir, channel=4, smoothing=BEACON_SMOOTHING, period=BEACON_PERIOD):
+        self.ir = ir
+        self.channel = channel
+        self.smoothing = smoothing
+        self.period = period
+        self.tracking = False
+        self.estimate = None
+        self.samples = 0
+        self.misses = 0
+        self.startedAt = None
+
+    def start(self):
+        self.estimate = None
+        self.samples = 0
+        self.misses = 0
+        self.startedAt = time.monotonic()
+        self.tracking = True
+
+    def stop(self):
+        self.tracking = False
+
+    def watching(self):
+        return self.tracking
+
+    def update(self):
+        # Polled by the sensor scheduler while tracking
+        # A single IR-SEEK reading gives both values of the channel
+        heading, distance = self.ir.heading_and_distance(self.channel)
+        if distance is None:
+            self.misses += 1
+            return
+        heading = math.radians(heading)
+        distance = 7 * distance # 700 milimeters / 100 (max percentage value ir distance)
+        estimate = self.estimate
+        if estimate is not None:
+            heading = estimate[0] + self.smoothing * (heading - estimate[0])
+            distance = estimate[1] + self.smoothing * (distance - estimate[1])
+        self.samples += 1
+        self.estimate = (heading, distance, time.monotonic())
+
+    def stats(self):
+        elapsed = time.monotonic() - self.startedAt if self.startedAt is not None else 0.0
+        return {'samples': self.samples, 'misses': self.misses,
+                'rate': round(self.samples / elapsed, 1) if elapsed else None,
+                # Delay of the exponential filter in following a step of the beacon
+                'filterLag': round(self.period * (1 - self.smoothing) / self.smoothing, 3)}
+
+
+class FleetClient(object):
+    '''
+    Connection of the gadget to the fleet coordinator. Trips are reserved on the shared field before being
+    driven, and the directives the coordinator dispatches to this robot are handed to onDirective.
+    The reserved durations are scaled by the pace of the robot, the measured ratio between the durations
+    of its trips and their estimates.
+    '''
+
+    def __init__(self, path, name, onDirective):
+        self.path = path
+        self.name = name
+        self.onDirective = onDirective
+        self.socket = None
+        self.connected = False
+        self.lock = threading.Lock()
+        self.requests = itertools.count(1)
+        self.replies = {}
+        self.pace = 1.0
+
+    def connect(self, places, place):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(self.path)
+        self.connected = True
+        self.send({'op': 'hello', 'robot': self.name, 'places': places, 'place': place})
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def send(self, message):
+        try:
+            with self.lock:
+                self.socket.sendall((json.dumps(message) + '\n').encode('utf-8'))
+            return True
+        except (IOError, OSError) as error:
+            print('Lost the fleet coordinator: {}'.format(error))
+            self.connected = False
+            return False
+
+    def reserve(self, trip):
+        '''
+        Asks for the legs of a trip, returns the reply of the coordinator or None if it does not answer.
+        :param trip: list of (fromPlace, toPlace, seconds) legs, the estimated durations
+        '''
+        request = next(self.requests)
+        waiter = [threading.Event(), None]
+        self.replies[request] = waiter
+        legs = [(fromPlace, toPlace, seconds * self.pace * FLEET_TIME_MARGIN) for fromPlace, toPlace, seconds in trip]
+        if not self.send({'op': 'reserve', 'id': request, 'trip': legs}) or not waiter[0].wait(FLEET_REPLY_TIMEOUT):
+            self.replies.pop(request, None)
+            return None
+        return waiter[1]
+
+    def arrived(self, place, estimated=None, elapsed=None):
+        # place is None when the robot stopped before the end of the trip
+        if place is not None and estimated:
+            self.pace += FLEET_PACE_SMOOTHING * (elapsed / estimated - self.pace)
+        self.send({'op': 'arrived', 'place': place})
+
+    def finished(self, ticket, status):
+        self.send({'op': 'finished', 'ticket': ticket, 'status': status})
+
+    def _run(self):
+        for line in self.socket.makefile('rb'):
+            try:
+                message = json.loads(line.decode('utf-8'))
+            except ValueError:
+                continue
+            op = message.get('op')
+            if op == 'reservation':
+                waiter = self.replies.pop(message['id'], None)
+                if waiter is not None:
+                    waiter[1] = message
+                    waiter[0].set()
+            elif op == 'directive':
+                self.onDirective(message['ticket'], message['payload'])
+            elif op == 'error':
+                print('Fleet coordinator: {}'.format(message['error']))
+        self.connected = False
+        print('The fleet coordinator closed the connection')
+
+
+class Clock(object):
+    '''
+    Time the sensor scheduler and the motion polling loops run on. The simulator replaces it with its
+    virtual clock, so the sensors are polled as often per virtual second whatever the speedup.
+    '''
+
+    def now(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        sleep(seconds)
+
+    def wait(self, event, timeout):
+        return event.wait(timeout)
+
+
+CLOCK = Clock()
+
+
+class SensorTask(object):
+    '''
+    A handler polled by the sensor scheduler, with the timings used to report how late and how long it runs.
+    '''
+
+    def __init__(self, name, period, handler, deadline, enabled=None):
+        self.name = name
+        self.period = period
+        self.handler = handler
+        self.deadline = deadline
+        self.enabled = enabled
+        self.runs = 0
+        self.lateness = 0.0
+        self.maxLateness = 0.0
+        self.duration = 0.0
+
+
+class SensorScheduler(object):
+    '''
+    Polls every sensor from a single thread, each handler at its own period. The handlers that are due
+    within the same tick are run together, so the thread wakes up once for all of them.
+    '''
+
+    def __init__(self, slack=0.005):
+        self.slack = slack
+        self.tasks = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+    def add(self, name, period, handler, delay=0.0, enabled=None):
+        '''
+        Registers a handler called every period seconds, starting after delay seconds.
+        :param enabled: optional function telling if the handler has to run in this tick
+        '''
+        with self.lock:
+            self.tasks.append(SensorTask(name, period, handler, CLOCK.now() + delay, enabled))
+        self.wakeup.set()
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def stats(self):
+        with self.lock:
+            return {task.name: {'runs': task.runs,
+                                'lateness': round(task.lateness / task.runs, 4) if task.runs else None,
+                                'maxLateness': round(task.maxLateness, 4),
+                                'duration': round(task.duration / task.runs, 4) if task.runs else None}
+                    for task in self.tasks}
+
+    def _run(self):
+        while True:
+            now = CLOCK.now()
+            with self.lock:
+                due = [task for task in self.tasks if task.deadline <= now + self.slack]
+            for task in due:
+                if task.enabled is None or task.enabled():
+                    started = CLOCK.now()
+                    try:
+                        task.handler()
+                    except Exception as error:
+                        print('Sensor task {} failed: {}'.format(task.name, error))
+                    finished = CLOCK.now()
+                    task.runs += 1
+                    late = max(0.0, started - task.deadline)
+                    task.lateness += late
+                    task.maxLateness = max(task.maxLateness, late)
+                    task.duration += finished - started
+                task.deadline += task.period
+                if task.deadline < now:
+                    # Skip the ticks that were missed instead of running them in a burst
+                    task.deadline = now + task.period
+
+            with self.lock:
+                nextDeadline = min((task.deadline for task in self.tasks), default=None)
+            timeout = None if nextDeadline is None else max(0.0, nextDeadline - CLOCK.now())
+            CLOCK.wait(self.wakeup, timeout)
+            self.wakeup.clear()
+
+
+class Odometry(object):
+    '''
+    Integrates the wheel encoders into the robot pose. Every update publishes a new immutable Pose,
+    so any thread can read the latest one from the pose attribute without locks or sysfs access.
+    '''
+
+    def __init__(self, leftMotor, rightMotor, wheelRadius, distanceWheels):
+        self.leftMotor = leftMotor
+        self.rightMotor = rightMotor
+        self.distanceWheels = distanceWheels
+        self.degreeLength = 2 * math.pi * wheelRadius / 360
+        # Only writers take the lock, so a reset is never overwritten by an update computed before it
+        self.lock = threading.Lock()
+        self.leftPosition = leftMotor.position
+        self.rightPosition = rightMotor.position
+        self.updates = 0
+        self.pose = Pose(0.0, 0.0, 0.0, time.monotonic())
+
+    def reset(self, x, y, orientation):
+        # Sets the pose when the robot position is known, like at a place or when the home button is pressed
+        with self.lock:
+            self.leftPosition = self.leftMotor.position
+            self.rightPosition = self.rightMotor.position
+            self.pose = Pose(x, y, orientation, time.monotonic())
+
+    def update(self):
+        # Polled by the sensor scheduler, it integrates the wheel movement since the previous update
+        with self.lock:
+            leftPosition = self.leftMotor.position
+            rightPosition = self.rightMotor.position
+            timestamp = time.monotonic()
+            left = (leftPosition - self.leftPosition) * self.degreeLength
+            right = (rightPosition - self.rightPosition) * self.degreeLength
+            self.leftPosition = leftPosition
+            self.rightPosition = rightPosition
+            self.updates += 1
+
+            pose = self.pose
+            # Same conventions as MindstormsGadget.turn: each wheel runs distanceWheels milimiters per radian turned
+            rotation = (left - right) / (2 * self.distanceWheels)
+            travel = (left + right) / 2
+            heading = pose.orientation + rotation / 2
+            orientation = (pose.orientation + rotation) % (2 * math.pi)
+            self.pose = Pose(pose.x + travel * math.cos(heading), pose.y + travel * math.sin(heading),
+                             orientation, timestamp)
+
+
+def normalizeAngle(angle):
+    # Brings an angle into [-pi, pi] so turns always take the short way round
+    while angle > math.pi:
+        angle -= 2*math.pi
+    while angle < -math.pi:
+        angle += 2*math.pi
+    return angle
 
 
 class MindstormsGadget(AlexaGadget):
@@ -38,16 +1699,22 @@ class MindstormsGadget(AlexaGadget):
     A Mindstorms gadget that can perform bi-directional interaction with an Alexa skill.
     '''
 
-    def __init__(self):
+    def __init__(self, stateFile=STATE_FILE, colorIndexFile=COLOR_INDEX_FILE):
         '''
         Performs Alexa Gadget initialization routines and ev3dev resource allocation.
+        :param stateFile: file the state is kept in, one per robot when several run on the same host
+        :param colorIndexFile: file the positions of the colors are kept in, one per robot as well
         '''
+        self.startup = StartupTimer(STARTED_AT)
+        self.startup.mark('imports')
         super().__init__()
+        self.startup.mark('gadget')
+
+        # Custom events are sent from their own thread so no caller waits for the Bluetooth link
+        self.events = EventSender(
+            lambda name, payload: self.send_custom_event('Custom.Mindstorms.Gadget', name.value, payload))
 
-        # Robot position and dimensions
-        self.x = 0.0
-        self.y = 0.0
-        self.orientation = 0.0
+        # Robot dimensions, the position is tracked by the odometry
         self.wheelRadius = 16.8 #milimiters
         self.distanceWheels = 100.0
 
@@ -63,6 +1730,13 @@ class MindstormsGadget(AlexaGadget):
             'colorsLineEnd': [800.0, 580.0, math.pi]
         }
 
+        # Legs the robot can drive between places. Home is only reached through its entrance, driving backwards
+        self.fieldEdges = [('home', 'homeEntrance', 'forward'), ('homeEntrance', 'home', 'reverse')]
+        self.fieldEdges += RoutePlanner.openField([place for place in self.toPlaces if place != 'home'])
+        self.routes = RoutePlanner(self.toPlaces, self.fieldEdges)
+        self.trajectories = TrajectoryPlanner(self.wheelRadius, self.distanceWheels)
+        self.tripTimes = deque(maxlen=32)
+
         # Positions of the different targets
         self.targets = {
             'plane': [1000.0,500.0],
@@ -71,18 +1745,35 @@ class MindstormsGadget(AlexaGadget):
             'tractor': [1050.0, 200.0]
         }
 
-        # Lego motors, leds, sound, sensors, display 
-        self.drive = MoveTank(OUTPUT_B, OUTPUT_C)
-        self.weapon = MediumMotor(OUTPUT_A)
-        self.sound = Sound()
-        self.leds = Leds()
-        self.ir = InfraredSensor()
-        self.ts = TouchSensor()
-        self.lcd = Display()
-        self.cs = ColorSensor()
+        # Lego motors, leds, sound and sensors, opened in parallel as each one waits on its own sysfs files
+        devices = {
+            'drive': lambda: MoveTank(OUTPUT_B, OUTPUT_C),
+            'weapon': lambda: MediumMotor(OUTPUT_A),
+            'sound': Sound,
+            'leds': Leds,
+            'ir': InfraredSensor,
+            'ts': TouchSensor,
+            'cs': ColorSensor,
+            'left_motor': lambda: LargeMotor(OUTPUT_B),
+            'right_motor': lambda: LargeMotor(OUTPUT_C)
+        }
+        with ThreadPoolExecutor(max_workers=len(devices)) as pool:
+            opening = {name: pool.submit(device) for name, device in devices.items()}
+        for name, device in opening.items():
+            setattr(self, name, device.result())
+        self.drive = TracedMotor(self.drive, 'drive')
+        self.weapon = TracedMotor(self.weapon, 'weapon')
+        self.startup.mark('devices')
+
+        self.audio = AudioPlayer(self.sound, './sounds', SOUND_PHRASES)
         self.cs.mode = self.cs.MODE_COL_COLOR
-        self.left_motor = LargeMotor(OUTPUT_B)
-        self.right_motor = LargeMotor(OUTPUT_C)
+        self.colors = ColorSampler(self.cs)
+        self.colorIndex = ColorIndex(colorIndexFile)
+        self.odometry = Odometry(self.left_motor, self.right_motor, self.wheelRadius, self.distanceWheels)
+        self.images = ImageCache('./images')
+        self.display = DisplayWorker(self._open_display, self.images)
+        self.executor = MotionExecutor(self.runCommand, self._halt, self._command_finished)
+        self.fleet = None
         self.ir.on_channel1_top_left = self.remote_move(self.left_motor, 800)
         self.ir.on_channel1_bottom_left = self.remote_move(self.left_motor, -800)
         self.ir.on_channel1_top_right = self.remote_move(self.right_motor, 800)
@@ -90,34 +1781,63 @@ class MindstormsGadget(AlexaGadget):
         self.ir.on_channel2_top_left = self.remote_useTool()
         self.ir.on_channel2_top_right = self.remote_useTool()
         self.ir.on_channel4_beacon = self.beacon_activation()
+        self.beaconTracker = BeaconTracker(self.ir)
 
-        # Default values
-        self.tool = 'gun'
-        self.picker = 'pick'
-        self.speed = 50
-        self.color = ''
-        self.detectedColor = 'none'
-        self.beacon = False
-        self.target = 'none'
-        self.findColorOn = False
-        self.ColorFound = False
-        self.targetColor = ''
-        self.fromPlace = 'home'
-        self.toPlace = 'home'
-        self.remoteDirection = 'forward'
-        self.remoteControl = False
+        # Default values, the settings and flags read and changed from several threads are kept in the shared state
+        self.state = SharedState(RobotState(
+            toolStates={tool.name: tool.initialState for tool in TOOLS.values() if tool.states is not None}))
+
+        # Tracing is switched on and dumped at runtime, without restarting the gadget
+        try:
+            signal.signal(signal.SIGUSR1, lambda signum, frame: TRACER.enable(not TRACER.enabled))
+            signal.signal(signal.SIGUSR2, lambda signum, frame: self.dumpTrace())
+        except ValueError:
+            # Signal handlers can only be set from the main thread
+            pass
+
+        # Resume from the state saved before the last shutdown or crash, so the robot does not need to go home first
+        self.snapshot = StateSnapshot(stateFile)
+        self.restoreState()
+
+        # Live status drawn over the images
+        self.display.addWidget('speed', HUD_WIDGETS['speed'], lambda: '{}%'.format(self.state.read().speed))
+        self.display.addWidget('tool', HUD_WIDGETS['tool'], lambda: self.state.read().tool)
+        self.display.addWidget('color', HUD_WIDGETS['color'], self._hud_color)
+        self.display.addWidget('pose', HUD_WIDGETS['pose'], self._hud_pose)
 
         self.show_image('Pinch left.bmp', 1)
         self.show_image('Pinch middle.bmp', 1)
         self.show_image('Pinch right.bmp', 1)
         self.show_image('Awake.bmp',0)
-        self.sound.speak('Lego robot, ready for action')
-
-        # Start threads for remote control, color sensor and touch sensor management
-        threading.Thread(target=self._remote_control, daemon=True).start()
-        threading.Thread(target=self._find_color, daemon=True).start()
-        threading.Thread(target=self._touch_sensor, daemon=True).start()
+        self.audio.speak('Lego robot, ready for action')
+        self.startup.mark('services')
+
+        # Poll the remote control, the touch sensor and the color sensor from a single thread
+        self.touchPressed = False
+        self.touchHandledAt = 0.0
+        self.remoteFiring = threading.Lock()
+        self.weaponLock = threading.Lock()
+        self.sensors = SensorScheduler()
+        # The remote is not polled during a pursuit, reading it would switch the sensor out of the beacon mode
+        self.sensors.add('ir', IR_POLL_PERIOD, self.ir.process, delay=3, enabled=lambda: not self.beaconTracker.watching())
+        self.sensors.add('odometry', ODOMETRY_PERIOD, self.odometry.update)
+        self.sensors.add('beacon', BEACON_PERIOD, self.beaconTracker.update, enabled=self.beaconTracker.watching)
+        self.sensors.add('touch', TOUCH_POLL_PERIOD, self._touch_sensor)
+        self.sensors.add('color', 1.0 / COLOR_SAMPLE_RATE, self.colors.poll, enabled=self.colors.watching)
+        self.sensors.add('state', STATE_PERIOD, self._save_state_periodically)
+        self.sensors.start()
+        self.startup.mark('sensors')
+        print(self.startup.report())
+
+        # ev3dev2.display and PIL take long to import on the EV3, the display is opened once everything else runs,
+        # while Bluetooth starts, and the splash frames queued above are shown as soon as it is open
+        self.display.start()
         
+    @staticmethod
+    def _open_display():
+        from ev3dev2.display import Display
+        return Display()
+
     def on_connected(self, device_addr):
         '''
         Gadget connected to the paired Echo device.
@@ -141,289 +1861,734 @@ class MindstormsGadget(AlexaGadget):
         Handles the Custom.Mindstorms.Gadget control directive.
         :param directive: the custom directive with the matching namespace and name
         '''
+        self.handleDirective(directive.payload)
+
+    def handleDirective(self, data, ticket=None):
+        '''
+        Runs a control directive sent by Alexa or dispatched by the fleet coordinator.
+        :param data: the JSON payload of the directive
+        :param ticket: the number of the fleet job, None for Alexa directives
+        '''
+        payload = None
+        directiveId = TRACER.newDirective()
         try:
-            payload = json.loads(directive.payload.decode('utf-8'))
+            with TRACER.span('decode'):
+                payload = json.loads(data.decode('utf-8'))
             print('Control payload: {}'.format(payload))
-            control_type = payload['type']
-            
-            self.ColorFound = False
-
-            if control_type == 'changeTool':
-                self.show_image('Medium motor.bmp', 1)
-                self.show_image('Wink.bmp', 0)    
-                self.tool = payload['tool']
-
-            elif control_type == 'useTool':
-                self.show_image('Boom.bmp', 1)                      
-                self.tool = payload['tool']   
-                self.useTool()
-
-            elif control_type == 'notRightTool':
-                self.show_image('Sick.bmp', 1)                      
-                self.show_image('Question mark.bmp', 0)
-
-            elif control_type == 'goSomewhere':
-                self.show_image('Accept.bmp', 1)                      
-                self.show_image('Lightning.bmp', 0) 
-                self.toPlace = payload['place'] 
-                self.speed = payload['speed'] 
-                if self.toPlace == 'home':
-                    self.goSomewhere('homeEntrance', self.speed)
-                    self.goSomewhere(self.toPlace, self.speed)
-                elif self.fromPlace == 'home':
-                    self.goSomewhere('homeEntrance', self.speed)
-                    self.goSomewhere(self.toPlace, self.speed)
-                else:
-                    self.goSomewhere(self.toPlace, self.speed)
+            command = self.parseCommand(payload)
+            command.directive = directiveId
+            command.ticket = ticket
+        except (KeyError, ValueError, TypeError) as error:
+            print('Missing or invalid parameters ({}): {}'.format(error, data))
+            if isinstance(payload, dict) and payload.get('type') == 'sequence':
+                self._send_event(EventName.SEQUENCE, {'status': 'rejected', 'error': str(error)})
+            if ticket is not None:
+                self.fleet.finished(ticket, 'invalid')
+            return
+
+        if command.name in MOTION_CONTROLS:
+            # Motion commands run in the motion worker, a newer one preempts the one in progress
+            self.executor.submit(command)
+            return
+        if command.name == 'stop':
+            # Cancel the running command and everything waiting behind it
+            self.executor.stop()
+        else:
+            self.runCommand(command)
+        command.status = 'done'
+        self._command_finished(command)
 
-            elif control_type == 'alreadyThere':
-                self.show_image('Knocked out.bmp', 1)    
+    def joinFleet(self, path=FLEET_SOCKET, name=None):
+        # Connects to the fleet coordinator, the robot keeps working alone if it is not there
+        self.fleet = FleetClient(path, name or self.friendly_name, self._fleet_directive)
+        try:
+            self.fleet.connect(self.toPlaces, self.state.read().fromPlace)
+        except (IOError, OSError) as error:
+            print('Cannot join the fleet at {}: {}'.format(path, error))
+            self.fleet = None
+            return False
+        print('Joined the fleet as {}'.format(self.fleet.name))
+        return True
+
+    def _fleet_directive(self, ticket, payload):
+        self.handleDirective(json.dumps(payload).encode('utf-8'), ticket)
+
+    def _command_finished(self, command):
+        # Tells the coordinator the job of a directive it dispatched is over
+        if command.ticket is not None and self.fleet is not None:
+            self.fleet.finished(command.ticket, command.status)
+
+    def parseCommand(self, payload):
+        '''
+        Builds a command from a control payload, checking that it carries the expected parameters with values
+        the robot can act on, so a bad value never reaches the shared state or the snapshot.
+        :param payload: the decoded control payload
+        '''
+        control_type = payload['type']
+        for parameter in CONTROL_PARAMETERS.get(control_type, ()):
+            self.checkParameter(parameter, payload[parameter])
+        command = Command(control_type, payload)
+
+        if control_type == 'sequence':
+            # Every step is checked before the sequence starts, so it never stops halfway on a bad step
+            if not isinstance(payload['steps'], list):
+                raise ValueError('steps is not a list: {}'.format(payload['steps']))
+            for index, step in enumerate(payload['steps']):
+                if not isinstance(step, dict) or step.get('type') not in SEQUENCE_CONTROLS:
+                    raise ValueError('step {} cannot be run in a sequence: {}'.format(index, step))
+                try:
+                    command.steps.append(self.parseCommand(step))
+                except (KeyError, ValueError, TypeError) as error:
+                    raise ValueError('step {} ({}): {}'.format(index, error, step))
+        return command
+
+    def checkParameter(self, name, value):
+        # Raises ValueError if the value of a control parameter is not one the robot knows
+        if name == 'speed':
+            valid = isinstance(value, (int, float)) and not isinstance(value, bool) and 0 <= value <= 100
+        elif name in ('place', 'target', 'tool', 'color', 'direction'):
+            known = {'place': self.toPlaces, 'target': list(self.targets) + ['mobile', 'none'], 'tool': TOOLS,
+                     'color': COLORS, 'direction': REMOTE_DIRECTIONS}[name]
+            valid = isinstance(value, str) and value in known
+        else:
+            valid = True
+        if not valid:
+            raise ValueError('invalid {}: {}'.format(name, value))
 
-            elif control_type == 'findColor':
-                self.show_image('Dizzy.bmp', 1)                      
-                self.show_image('Color sensor.bmp', 0)     
-                self.color = payload['color'] 
-                self.speed = payload['speed'] 
-                self.findColor(self.color, self.speed)            
+    def runCommand(self, command):
+        '''
+        Executes a parsed control command. Motion commands are run from the motion worker thread.
+        :param command: the command to run
+        '''
+        if command.directive is not None:
+            # The motion worker runs the command, its spans belong to the directive of the command
+            TRACER.setDirective(command.directive)
+        with TRACER.span(command.name):
+            try:
+                payload = command.payload
+                control_type = command.name
+
+                self.state.update(colorFound=False)
+
+                if control_type == 'changeTool':
+                    self.show_image('Medium motor.bmp', 1)
+                    self.show_image('Wink.bmp', 0)    
+                    self.state.update(tool=payload['tool'])
+
+                elif control_type == 'useTool':
+                    self.show_image('Boom.bmp', 1)                      
+                    self.state.update(tool=payload['tool'])
+                    self.useTool()
+
+                elif control_type == 'notRightTool':
+                    self.show_image('Sick.bmp', 1)                      
+                    self.show_image('Question mark.bmp', 0)
+
+                elif control_type == 'goSomewhere':
+                    self.show_image('Accept.bmp', 1)                      
+                    self.show_image('Lightning.bmp', 0) 
+                    self.state.update(toPlace=payload['place'], speed=payload['speed'])
+                    self.goToPlace(payload['place'], payload['speed'])
+
+                elif control_type == 'alreadyThere':
+                    self.show_image('Knocked out.bmp', 1)    
+
+                elif control_type == 'findColor':
+                    self.show_image('Dizzy.bmp', 1)                      
+                    self.show_image('Color sensor.bmp', 0)     
+                    self.state.update(color=payload['color'], speed=payload['speed'])
+                    self.findColor(payload['color'], payload['speed'])
                 
-            elif control_type == 'setSpeed':      
-                self.speed = payload['speed']
-                self.sound.play_file('./sounds/Blip.wav')
-                if (self.speed == 100):
-                    self.show_image('Dial 4.bmp', 0) 
-                if (self.speed == 50):
-                    self.show_image('Dial 2.bmp', 0)   
-                if (self.speed == 20):
-                    self.show_image('Dial 0.bmp', 0)
-                # Send event from EV3 gadget to Alexa
-                self._send_event(EventName.SETSPEED, {'speed': self.speed})
-
-            elif control_type == 'setTarget':
-                self.sound.play_file('./sounds/Blip.wav')
-                self.show_image('Target.bmp', 0)   
-                self.target = payload['target']
-                print("target = {}".format(self.target))
-                # Send event from EV3 gadget to Alexa
-                self._send_event(EventName.SETTARGET, {'target': self.target})
+                elif control_type == 'setSpeed':      
+                    speed = payload['speed']
+                    self.state.update(speed=speed)
+                    self.audio.play_file('./sounds/Blip.wav')
+                    if (speed == 100):
+                        self.show_image('Dial 4.bmp', 0) 
+                    if (speed == 50):
+                        self.show_image('Dial 2.bmp', 0)   
+                    if (speed == 20):
+                        self.show_image('Dial 0.bmp', 0)
+                    # Send event from EV3 gadget to Alexa
+                    self._send_event(EventName.SETSPEED, {'speed': speed}, command)
+
+                elif control_type == 'setTarget':
+                    self.audio.play_file('./sounds/Blip.wav')
+                    self.show_image('Target.bmp', 0)   
+                    target = payload['target']
+                    self.state.update(target=target)
+                    print("target = {}".format(target))
+                    # Send event from EV3 gadget to Alexa
+                    self._send_event(EventName.SETTARGET, {'target': target}, command)
             
-            elif control_type == 'moveRemote':
-                self.remoteControl = True
-                self.show_image('EV3 icon.bmp', 0)   
-                self.remoteDirection = payload['direction']
-                if self.remoteDirection == 'forward':
-                    self.move(100)
-                elif self.remoteDirection == 'backward':
-                    self.speed = 0 - self.speed
-                    self.move(100)
-                    self.speed = 0 - self.speed
-                elif self.remoteDirection == 'left':
-                    self.turn(math.pi/2)
-                elif self.remoteDirection == 'right':
-                    self.turn(-math.pi/2)
-                # Send event from EV3 gadget to Alexa
-                self._send_event(EventName.SETTARGET, {'target': self.target})
-
-            elif control_type == 'noPositionKnown':
-                self.show_image('Touch sensor.bmp', 0)
-
-            elif control_type == 'alexaTalk':
-                self.show_image('Dizzy.bmp', 0)
-            else:
-                self.show_image('Question mark.bmp', 0)
-
-        except KeyError:
-            print('Missing expected parameters: {}'.format(directive))
-
-    def goSomewhere(self, toPlace, speed):
-        
-        coordinates = self.toPlaces[toPlace]
-
-        finalX = coordinates[0]
-        finalY = coordinates[1]
-        finalOrientation = coordinates[2]
-        journeyX = finalX - self.x
-        journeyY = finalY - self.y
+                elif control_type == 'moveRemote':
+                    direction = payload['direction']
+                    state = self.state.update(remoteControl=True, remoteDirection=direction)
+                    self.show_image('EV3 icon.bmp', 0)   
+                    if direction == 'forward':
+                        self.move(100)
+                    elif direction == 'backward':
+                        # The speed setting is left as it is, other threads keep reading it while the robot backs up
+                        self.move(100, -state.speed)
+                    elif direction == 'left':
+                        self.turn(math.pi/2)
+                    elif direction == 'right':
+                        self.turn(-math.pi/2)
+                    # Send event from EV3 gadget to Alexa
+                    self._send_event(EventName.SETTARGET, {'target': state.target}, command)
+
+                elif control_type == 'sequence':
+                    self.runSequence(command)
+
+                elif control_type == 'noPositionKnown':
+                    self.show_image('Touch sensor.bmp', 0)
+
+                elif control_type == 'alexaTalk':
+                    self.show_image('Dizzy.bmp', 0)
+                else:
+                    self.show_image('Question mark.bmp', 0)
 
-        #distance between initial and final point
-        journeyDistance = math.hypot(journeyX,journeyY)
+            except KeyError:
+                print('Missing expected parameters: {}'.format(command.payload))
+            finally:
+                self.saveState()
 
-        #direction to get there
-        journeyDirection = self.calculateJourneyDirection(journeyX, journeyY)
-        turnJourneyDirection = journeyDirection - self.orientation 
+    def runSequence(self, command):
+        '''
+        Runs the steps of a sequence one after the other without going back to Alexa in between.
+        The events of the steps are gathered and sent in a single Sequence event when it ends or fails.
+        :param command: the sequence command, with its parsed steps
+        '''
+        results = {}
+        command.results = results
+        index = 0
+        status = 'failed'
+        error = None
+        try:
+            for index, step in enumerate(command.steps):
+                command.check()
+                print('Sequence step {}/{}: {}'.format(index + 1, len(command.steps), step.name))
+                step.results = results
+                self.runCommand(step)
+            status = 'done'
+        except CommandPreempted:
+            status = 'preempted'
+            raise
+        except CommandFailed as failure:
+            error = str(failure)
+            raise
+        finally:
+            command.results = None
+            event = {'status': status, 'steps': len(command.steps), 'results': results}
+            if status != 'done':
+                event['step'] = index
+                event['type'] = command.steps[index].name if command.steps else None
+            if error is not None:
+                event['error'] = error
+            self._send_event(EventName.SEQUENCE, event)
+
+    def dumpTrace(self, path=TRACE_FILE):
+        # Writes the spans in the Chrome trace format and prints their latency histograms
+        count = TRACER.dump(path)
+        print('Trace of {} spans written to {}'.format(count, path))
+        for name, histogram in TRACER.histograms().items():
+            print('{}: {}'.format(name, histogram))
+        for name, stats in self.stats().items():
+            print('{} stats: {}'.format(name, stats))
+
+    def stats(self):
+        # Counters of every worker of the robot, printed with the trace and added to the benchmark report
+        return {
+            'executor': self.executor.stats(),
+            'sensors': self.sensors.stats(),
+            'colors': self.colors.stats(),
+            'beacon': self.beaconTracker.stats(),
+            'audio': self.audio.stats(),
+            'events': self.events.stats(),
+            'display': self.display.stats(),
+            'images': self.images.stats(),
+            'snapshot': self.snapshot.stats()
+        }
 
-        # If robot coming back to home position we move backwards from homeEntrance
-        if ((self.fromPlace == 'homeEntrance') and (self.toPlace == 'home')):
-            self.moveBackwards(journeyDistance)
-        else:
-            # Robot turns to face direction, moves the distance and turns when in destination
-            self.turn(turnJourneyDirection)
-            self.move(journeyDistance)
-            turnFinalOrientation = finalOrientation - journeyDirection        
-            self.turn(turnFinalOrientation)
+    def saveState(self):
+        # Cheap enough to be called on every state change, nothing is written if the state did not change
+        pose = self.odometry.pose
+        state = self.state.read()
+        try:
+            # The speed is kept as a whole percentage
+            speed = int(round(abs(state.speed)))
+        except (TypeError, ValueError, OverflowError) as error:
+            # Like a state the snapshot cannot pack, it is skipped so it never breaks the command that saves it
+            print('Cannot save the state with speed {!r}: {}'.format(state.speed, error))
+            return
+        self.snapshot.write((pose.x, pose.y, pose.orientation, speed, state.remoteControl,
+                             state.fromPlace or '', state.target, state.tool, state.toolStates.get('picker', '')))
+
+    def restoreState(self):
+        state = self.snapshot.read()
+        if state is None:
+            return
+        current = self.state.read()
+        # A trip cut short by the crash left the robot somewhere unknown, the next one starts from its pose
+        place = state['fromPlace'] if state['fromPlace'] in self.toPlaces else None
+        toolStates = dict(current.toolStates)
+        if state['picker']:
+            toolStates['picker'] = state['picker']
+        resumed = self.state.update(
+            speed=state['speed'], remoteControl=state['remoteControl'], fromPlace=place, toPlace=place,
+            target=state['target'], tool=state['tool'] if state['tool'] in TOOLS else current.tool, toolStates=toolStates)
+        self.setPosition(state['x'], state['y'], state['orientation'])
+        print('Resumed from state {}: at {} ({:.0f}, {:.0f}) with {}'.format(
+            state['sequence'], resumed.fromPlace, state['x'], state['y'], resumed.tool))
+
+    def _save_state_periodically(self):
+        # Polled by the sensor scheduler, it keeps the pose saved while the robot is driven by the remote
+        self.saveState()
+        self.snapshot.flush()
+
+    def startPlace(self, toPlace):
+        '''
+        Returns the place a trip to the given place is planned from: the last place reached if the robot is
+        still at it, else the place closest to the odometry pose.
+        '''
+        pose = self.odometry.pose
+        distance = lambda place: math.hypot(self.toPlaces[place][0] - pose.x, self.toPlaces[place][1] - pose.y)
+        fromPlace = self.state.read().fromPlace
+        if fromPlace in self.toPlaces and distance(fromPlace) <= PLACE_TOLERANCE:
+            return fromPlace
+        closest = min(self.toPlaces, key=distance)
+        if distance(closest) <= PLACE_TOLERANCE:
+            return closest
+        # Away from every place, the destination itself is no start or its legal entry legs would be skipped
+        return min((place for place in self.toPlaces if place != toPlace), key=distance)
+
+    def goToPlace(self, toPlace, speed):
+        # Drives the cheapest legal route from the place the robot is at, or closest to, as a single trajectory
+        fromPlace = self.startPlace(toPlace)
+        legs = self.routes.route(fromPlace, toPlace)
+        if legs is None:
+            self.show_image('Question mark.bmp', 0)
+            raise CommandFailed('No route from {} to {}'.format(fromPlace, toPlace))
+        if not legs:
+            # Already there, only straighten up on the place
+            legs = [(toPlace, 'forward')]
+        self.driveLegs(legs, speed)
+
+    def goSomewhere(self, toPlace, speed, reverse=False):
+        # Drives straight to a place, backwards on reverse legs
+        self.driveLegs([(toPlace, 'reverse' if reverse else 'forward')], speed)
+
+    def driveLegs(self, legs, speed):
+        # Plans the legs as one blended trajectory, drives it and records the final position and orientation
+        waypoints = [(self.toPlaces[place][0], self.toPlaces[place][1], mode == 'reverse') for place, mode in legs]
+        finalPlace = legs[-1][0]
+        finalX, finalY, finalOrientation = self.toPlaces[finalPlace]
+
+        pose = self.odometry.pose
+        segments = self.trajectories.plan((pose.x, pose.y, pose.orientation), waypoints, finalOrientation)
+        fleet = self.fleet if self.fleet is not None and self.fleet.connected else None
+        estimated = None
+        if fleet is not None:
+            # Other robots drive on the same field, wait until the whole trip is clear of them
+            estimated = self._reserve_trip(legs, segments, speed)
+            if estimated is None:
+                self.show_image('Question mark.bmp', 0)
+                raise CommandFailed('The field stays blocked, trip to {} cancelled'.format(finalPlace))
+        start = time.monotonic()
+        try:
+            completed = self.runTrajectory(segments, speed)
+        except CommandPreempted:
+            # Stopped somewhere along the way, the next trip starts from the pose
+            self.state.update(fromPlace=None)
+            if fleet is not None:
+                fleet.arrived(None)
+            raise
+        elapsed = time.monotonic() - start
+        self.tripTimes.append((finalPlace, len(legs), len(segments), elapsed))
+        print('Trip to {}: {} legs, {} segments, {:.2f}s'.format(finalPlace, len(legs), len(segments), elapsed))
+
+        if completed:
+            # Snap to the place so the encoder drift does not build up from trip to trip
+            self.setPosition(finalX, finalY, finalOrientation)
+        self.state.update(fromPlace=finalPlace if completed else None)
+        if fleet is not None:
+            fleet.arrived(finalPlace if completed else None, estimated, elapsed)
+
+    def _reserve_trip(self, legs, segments, speed):
+        '''
+        Reserves the legs of a trip with the fleet coordinator and waits for the time it was given.
+        Returns the estimated duration of the trip, or None if the field stayed blocked.
+        '''
+        # The faster wheel of every segment runs at the given speed, the trip time is split between the legs by length
+        degreesPerSecond = abs(speed) / 100 * self.left_motor.max_speed
+        total = sum(max(abs(left), abs(right)) for left, right in segments) / degreesPerSecond if degreesPerSecond else 0.0
+        fromPlace = self.startPlace(legs[-1][0])
+        lengths = []
+        for place, mode in legs:
+            fromX, fromY = self.toPlaces[fromPlace][:2]
+            toX, toY = self.toPlaces[place][:2]
+            lengths.append((fromPlace, place, math.hypot(toX - fromX, toY - fromY) + 1.0))
+            fromPlace = place
+        length = sum(leg[2] for leg in lengths)
+        trip = [(start, end, total * legLength / length) for start, end, legLength in lengths]
+
+        command = self.executor.current
+        deadline = time.monotonic() + FLEET_WAIT_TIMEOUT
+        while True:
+            reply = self.fleet.reserve(trip)
+            if reply is None:
+                # Without an answer from the coordinator the robot drives on its own, as before joining the fleet
+                return total
+            if reply['ok']:
+                break
+            if time.monotonic() >= deadline:
+                return None
+            print('Field blocked by {}'.format(reply['blockedBy']))
+            if command is not None:
+                command.sleep(FLEET_RETRY)
+            else:
+                sleep(FLEET_RETRY)
+        if reply['start'] > 0:
+            print('Waiting {:.2f}s for the field'.format(reply['start']))
+            if command is not None:
+                command.sleep(reply['start'])
+            else:
+                sleep(reply['start'])
+        return total
 
-        # Record the final position and orientation
-        self.setPosition(finalX, finalY, finalOrientation)
-        self.fromPlace = toPlace
+    def runTrajectory(self, segments, speed):
+        '''
+        Drives the segments back to back. Every segment but the last one coasts and the next one is started
+        as soon as the faster wheel reaches its target, so the robot does not stop in between.
+        Returns False if the drive was stopped from outside, like when the color sensor finds the color.
+        :param segments: list of (leftDegrees, rightDegrees) from TrajectoryPlanner.plan
+        :param speed: speed percentage of the faster wheel
+        '''
+        command = self.executor.current
+        for index, (left, right) in enumerate(segments):
+            if self.state.read().colorFound:
+                return False
+            last = index == len(segments) - 1
+            degrees = max(abs(left), abs(right))
+            leader = self.left_motor if abs(left) >= abs(right) else self.right_motor
+            origin = leader.position
+            self.drive.on_for_degrees(SpeedPercent(speed * left / degrees), SpeedPercent(speed * right / degrees),
+                                      degrees, brake=last, block=False)
+            leader.wait_until('running', timeout=WAIT_RUNNING_TIMEOUT)
+            if last:
+                self._wait_drive()
+                break
+            while abs(leader.position - origin) < degrees - SEGMENT_TOLERANCE:
+                if command is not None and command.cancelled.is_set():
+                    self.drive.off()
+                    raise CommandPreempted(command.name)
+                if not leader.is_running:
+                    # Stopped before reaching the target, by a preemption or something else turning the drive off
+                    if command is not None:
+                        command.check()
+                    return False
+                CLOCK.sleep(0.01)
+        return True
 
     def calculateJourneyDirection(self, journeyX, journeyY):
-        direction = math.atan(journeyY/journeyX)
-        if journeyX < 0:
-            direction += math.pi
+        direction = math.atan2(journeyY, journeyX)
         if direction < 0: 
             direction += 2*math.pi             
         return direction
 
     def turn(self, angle):
-        if angle > math.pi:
-            angle = angle - 2*math.pi
-        elif angle < -math.pi:
-            angle = angle + 2*math.pi
+        angle = normalizeAngle(angle)
         degrees = (360 * self.distanceWheels * angle) / (2 * math.pi * self.wheelRadius)
-        if self.ColorFound == False:
-            self.drive.on_for_degrees(SpeedPercent(self.speed), SpeedPercent(-self.speed), degrees, block=True)
-
-    def move(self, distance):
-        degrees = (360 * distance) / (2 * math.pi * self.wheelRadius)
-        self.drive.on_for_degrees(SpeedPercent(self.speed), SpeedPercent(self.speed), degrees, block=True)
+        state = self.state.read()
+        if state.colorFound == False:
+            self.drive.on_for_degrees(SpeedPercent(state.speed), SpeedPercent(-state.speed), degrees, block=False)
+            self._wait_drive()
 
-    def moveBackwards(self, distance):
+    def move(self, distance, speed=None):
+        speed = self.state.read().speed if speed is None else speed
         degrees = (360 * distance) / (2 * math.pi * self.wheelRadius)
-        self.drive.on_for_degrees(SpeedPercent(-self.speed), SpeedPercent(-self.speed), degrees, block=True)
+        self.drive.on_for_degrees(SpeedPercent(speed), SpeedPercent(speed), degrees, block=False)
+        self._wait_drive()
+
+    def _wait_drive(self):
+        # Wait for the drive to finish the move while checking if the running command has been preempted
+        command = self.executor.current
+        for motor in (self.left_motor, self.right_motor):
+            motor.wait_until('running', timeout=WAIT_RUNNING_TIMEOUT)
+        while not (self.left_motor.wait_until_not_moving(timeout=50) and self.right_motor.wait_until_not_moving(timeout=50)):
+            if command is not None and command.cancelled.is_set():
+                self.drive.off()
+                raise CommandPreempted(command.name)
+        # The halt of a preempted command stops the motors too, that move did not end where it should
+        if command is not None:
+            command.check()
+
+    def _halt(self):
+        # Stops every motor when the running command is preempted
+        self.state.update(findColorOn=False)
+        self.colors.unsubscribe()
+        self.drive.off()
+        self.weapon.off()
+
+    @property
+    def x(self):
+        return self.odometry.pose.x
+
+    @property
+    def y(self):
+        return self.odometry.pose.y
+
+    @property
+    def orientation(self):
+        return self.odometry.pose.orientation
 
     def setPosition(self, newX, newY, newOrientation):
             if newOrientation < 0:
                 newOrientation += 2 * math.pi
             elif newOrientation >= 2 * math.pi:
                 newOrientation -= 2 * math.pi
-            self.x = float(newX)
-            self.y = float(newY)
-            self.orientation = float(newOrientation)
+            self.odometry.reset(float(newX), float(newY), float(newOrientation))
+            self.saveState()
 
     def findColor(self, color, speed):
-        #Move to the colorsLine position to start scan colors. If the initial position is home move to homeEntrance first
-        self.toPlace = 'colorsLineStart'
-        if self.fromPlace == 'home':
-            self.goSomewhere('homeEntrance', self.speed)
-        self.goSomewhere(self.toPlace, speed)
-        
-        self.targetColor = color
-        self.findColorOn = True
-
-        time.sleep(2)
-        if self.findColorOn == True:
-            self.toPlace = 'colorsLineEnd'
-            self.goSomewhere(self.toPlace, 30)
+        #Move to the colorsLine position to start scan colors, the route planner takes care of leaving home
+        self.state.update(toPlace='colorsLineStart')
+        self.goToPlace('colorsLineStart', speed)
+
+        # The sampler sees the color as soon as it is subscribed, the scan starts right away
+        command = self.executor.current
+        self.state.update(color=color, findColorOn=True)
+        self.colors.subscribe(color, lambda detectedColor, detectedAt: self._color_found(detectedColor, detectedAt, command))
+
+        known = self.colorIndex.lookup(color)
+        if self.state.read().findColorOn == True and known is not None:
+            # The color was seen in a previous sweep, drive straight to it and confirm it with a short scan
+            self.move(max(0.0, known - COLOR_CONFIRM_MARGIN), speed)
+            if self.state.read().findColorOn == True:
+                self.move(2 * COLOR_CONFIRM_MARGIN, 30)
+            if self.state.read().findColorOn == True:
+                print('Color {} is not at {:.0f}mm any more, sweeping the whole line'.format(color, known))
+                self.colorIndex.forget(color)
+                self.goSomewhere('colorsLineStart', speed)
+
+        if self.state.read().findColorOn == True:
+            self.state.update(toPlace='colorsLineEnd')
+            # Index the colors seen along the line while sweeping it
+            self.colorIndex.begin()
+            self.colors.recorder = self._record_color
+            try:
+                self.goSomewhere('colorsLineEnd', 30)
+            finally:
+                self.colors.recorder = None
+                self.colorIndex.end()
             
-            # Send event from EV3 gadget to Alexa
-            if self.ColorFound == False:
-                self._send_event(EventName.FINDCOLOR, {'color': "none"})
+            # Send event from EV3 gadget to Alexa, unless the sampler found the color meanwhile
+            if self.state.setIf('findColorOn', True, False):
+                self.colors.unsubscribe(color)
+                self._send_event(EventName.FINDCOLOR, {'color': "none"}, command)
      
     def useTool(self):
         # Robot turns to face the target and depending on the weapon it has it moves closer to the specified target
-        self.faceTarget()
-        self.sound.play_file('./sounds/Laser.wav')
-        if (self.tool == 'gun'):
-            self.weapon.on_for_degrees(SpeedPercent(100), 1000)
-
-        elif (self.tool == 'hammer'):
-            self.weapon.on_for_degrees(SpeedPercent(100), 200)
-            self.weapon.on_for_degrees(SpeedPercent(-50), 200)
-
-        elif (self.tool == 'picker'):
-            # Checking if the picker is open to close it and the pother way around
-            if (self.picker == 'pick'):
-                self.weapon.on_for_degrees(SpeedPercent(100), 90)
-                self.picker = 'leave'
-
-            elif (self.picker == 'leave'):
-                self.weapon.on_for_degrees(SpeedPercent(-100), 90)
-                self.picker = 'pick'
-
-        elif (self.tool == 'blade'):
-            self.weapon.on_for_degrees(SpeedPercent(100), 360)
-            self.weapon.on_for_degrees(SpeedPercent(-100), 360)
-
-    def faceTarget(self):
-        if ((self.target != 'none') and (self.remoteControl == False)):
+        state = self.state.read()
+        tool = TOOLS.get(state.tool)
+        if tool is None:
+            self.show_image('Question mark.bmp', 0)
+            raise CommandFailed('Unknown tool {}'.format(state.tool))
+        command = self.executor.current
+        start = time.monotonic()
+        actuation = self.faceTarget(tool, state)
+        if actuation is None:
+            self.fireTool(tool, './sounds/Laser.wav', command)
+        else:
+            # The weapon started during the approach
+            actuation.join()
+            if command is not None:
+                command.check()
+        print('Attack with {}: {:.2f}s'.format(tool.name, time.monotonic() - start))
+
+    def fireTool(self, tool, sound, command=None):
+        '''
+        Makes the weapon moves of the tool in its current state, used by both the voice and the remote control.
+        :param command: the running command, the moves stop when it is preempted, None for the remote control
+        '''
+        # Both the voice and the remote can fire at once, they take turns on the weapon motor
+        while not self.weaponLock.acquire(timeout=0.05):
+            if command is not None:
+                command.check()
+        try:
+            self.audio.play_file(sound)
+            while True:
+                # The tool state is shared with the snapshot, only one of them moves the tool from a given state
+                current = self.state.read()
+                steps, toolState = tool.actions(current.toolStates.get(tool.name))
+                if toolState is None:
+                    break
+                toolStates = dict(current.toolStates)
+                toolStates[tool.name] = toolState
+                if self.state.compareAndSet(current, toolStates=toolStates) is not None:
+                    self.saveState()
+                    break
+            for speed, degrees in steps:
+                # The halt of a preempted command stops the weapon, the move it was making returns early
+                if command is not None:
+                    command.check()
+                self.weapon.on_for_degrees(SpeedPercent(speed), degrees)
+            if command is not None:
+                command.check()
+        finally:
+            self.weaponLock.release()
+
+    def _actuate(self, tool, command):
+        # Weapon thread started by approach, it ends early when the command is preempted
+        try:
+            self.fireTool(tool, './sounds/Laser.wav', command)
+        except CommandPreempted:
+            pass
+
+    def approach(self, distance, tool):
+        '''
+        Drives the distance towards the target. If the tool has a lead, the weapon is started in its own thread
+        when the remaining distance gets within it, and that thread is returned. Otherwise returns None.
+        '''
+        if tool.lead <= 0 or distance <= tool.lead:
+            self.move(distance)
+            return None
+        command = self.executor.current
+        degrees = (360 * distance) / (2 * math.pi * self.wheelRadius)
+        leadDegrees = (360 * tool.lead) / (2 * math.pi * self.wheelRadius)
+        origin = self.left_motor.position
+        speed = self.state.read().speed
+        self.drive.on_for_degrees(SpeedPercent(speed), SpeedPercent(speed), degrees, block=False)
+        self.left_motor.wait_until('running', timeout=WAIT_RUNNING_TIMEOUT)
+        while abs(self.left_motor.position - origin) < degrees - leadDegrees and self.left_motor.is_running:
+            if command is not None and command.cancelled.is_set():
+                self.drive.off()
+                raise CommandPreempted(command.name)
+            CLOCK.sleep(0.01)
+        if command is not None:
+            command.check()
+        actuation = threading.Thread(target=self._actuate, args=(tool, command), daemon=True)
+        actuation.start()
+        self._wait_drive()
+        return actuation
+
+    def faceTarget(self, tool, state):
+        # Returns the thread of the weapon if it was started during the approach, None otherwise
+        actuation = None
+        if ((state.target not in ('none', 'mobile')) and (state.remoteControl == False)):
             # Robot turns to face the target and move depending on the tool
-            print("entra")
-            coordinates = self.targets[self.target]
+            coordinates = self.targets[state.target]
             targetX = coordinates[0]
             targetY = coordinates[1]   
-            directionX = targetX - self.x
-            directionY = targetY - self.y
+            pose = self.odometry.pose
+            directionX = targetX - pose.x
+            directionY = targetY - pose.y
             
             # Turning to direction to face the target
             direction = self.calculateJourneyDirection(directionX, directionY)
-            turnDirection = direction - self.orientation     
+            turnDirection = direction - pose.orientation     
             self.turn(turnDirection)  
 
             # Calculate the distance to move with an offset depending on the weapon the robot has
             distance = math.hypot(directionX,directionY)            
-            if (self.tool == 'gun'):
-                offset = distance
-            if (self.tool == 'hammer'):
-                offset = 130
-            if (self.tool == 'blade'):
-                offset = 80
-            if (self.tool == 'picker'):
-                offset = 80
-            self.move(distance-offset)
-
-            # Record the final position and orientation
-            finalX = targetX - offset* math.cos(direction)
-            finalY = targetY - offset * math.sin(direction)
-            self.setPosition(finalX, finalY, direction)
-
-        elif (self.target == 'mobile'):
+            offset = tool.approachOffset(distance)
+            actuation = self.approach(distance-offset, tool)
+
+            # Keep the measured pose, the approach may have stopped short of the planned one
+            self.odometry.update()
+            self.saveState()
+
+        elif (state.target == 'mobile'):
             # Send event from EV3 gadget to Alexa as we will not track the position of the robot
             self._send_event(EventName.REMOTECONTROL, {})
-            self.remoteControl = True
-
-            heading = self.ir.heading(4)
-            turnDirection = math.radians(heading) + math.pi # We add pi because the IR is pointing backwards
-            infraredDistance = 7 # 700 milimeters / 100 (max percentage value ir distance)
-            distance = infraredDistance * self.ir.distance(4)
-            self.turn(turnDirection)
-
-            if (self.tool == 'gun'):
-                offset = distance
-            if (self.tool == 'hammer'):
-                offset = 130
-            if (self.tool == 'blade'):
-                offset = 80
-            if (self.tool == 'picker'):
-                offset = 80
-            self.move(distance-offset)
-
-            # We cannot ensure that infraredDistance is 70cm max so we do not trust the calculus of the position
-            # finalX = self.x - (distance-offset) * math.cos(direction)
-            # finalY = self.y - (distance-offset) * math.sin(direction)
-            # self.setPosition(finalX, finalY, direction)
+            self.state.update(remoteControl=True)
+
+            # The beacon moves, follow it until the tool is close enough, the odometry keeps track of the position
+            self.pursueBeacon(tool)
+        return actuation
+
+    def pursueBeacon(self, tool):
+        '''
+        Steers the robot towards the IR beacon from the filtered heading and distance until the tool offset is
+        reached, then turns so the weapon faces it. The IR sensor points backwards, so the robot backs up to
+        the beacon to keep seeing it.
+        '''
+        command = self.executor.current
+        speed = abs(self.state.read().speed)
+        tracker = self.beaconTracker
+        tracker.start()
+        started = time.monotonic()
+        iterations = 0
+        heading = 0.0
+        intercepted = False
+        try:
+            while time.monotonic() - started < BEACON_TIMEOUT:
+                if command is not None and command.cancelled.is_set():
+                    self.drive.off()
+                    raise CommandPreempted(command.name)
+                estimate = tracker.estimate
+                seenAt = estimate[2] if estimate is not None else started
+                if time.monotonic() - seenAt > BEACON_LOST_TIMEOUT:
+                    print('Beacon lost')
+                    break
+                if estimate is not None:
+                    heading, distance = estimate[0], estimate[1]
+                    if distance <= tool.approachOffset(distance):
+                        intercepted = True
+                        break
+                    # Backing up, a positive heading turns like MindstormsGadget.turn does with a positive angle
+                    steer = max(-1.0, min(1.0, BEACON_GAIN * heading)) * speed
+                    self.drive.on(SpeedPercent(max(-100, min(100, -speed + steer))),
+                                  SpeedPercent(max(-100, min(100, -speed - steer))))
+                iterations += 1
+                CLOCK.sleep(tracker.period)
+        finally:
+            tracker.stop()
+            self.drive.off()
+
+        elapsed = time.monotonic() - started
+        print('Beacon {} in {:.2f}s, loop {:.1f}Hz, tracker {}'.format(
+            'intercepted' if intercepted else 'not reached', elapsed, iterations / elapsed if elapsed else 0.0, tracker.stats()))
+        # Turn around so the weapon faces the beacon
+        self.turn(heading + math.pi)
+
+    def _hud_color(self):
+        # Last color seen while looking for one
+        samples = self.colors.samples
+        return samples[-1] if samples and self.colors.watching() else ''
+
+    def _hud_pose(self):
+        # In centimeters to fit the box
+        pose = self.odometry.pose
+        return '{:.0f},{:.0f}'.format(pose.x / 10, pose.y / 10)
 
     def show_image(self, image_name, time):
-        image_path = './images/'+ image_name
-        image = Image.open(image_path)
-        self.lcd.image.paste(image, (0,0))
-        self.lcd.update()
-        sleep(time) 
+        # The display worker shows the image and keeps it on screen for the given time without blocking the caller
+        with TRACER.span('show_image', image=image_name):
+            self.display.show(image_name, time)
 
-    def _send_event(self, name: EventName, payload):
+    def _send_event(self, name: EventName, payload, command=None):
         '''
-        Sends a custom event to trigger a sentry action.
+        Queues a custom event to trigger a sentry action, it returns without waiting for the event to be sent.
         :param name: the name of the custom event
         :param payload: the sentry JSON payload
+        :param command: the command the event reports on, if any
         '''
-        self.send_custom_event('Custom.Mindstorms.Gadget', name.value, payload)
+        with TRACER.span('_send_event', event=name.value):
+            results = command.results if command is not None else None
+            if results is not None and name in SEQUENCE_EVENTS:
+                # A sequence is running, its steps report in the event sent at the end of it
+                results[name.value] = payload
+                return
+            self.events.post(name, payload)
 
     def remote_move(self, motor, speed):
         # Depending on the button pressed the motor connected to it will run while button is pressed
         def on_press(state):
             print('remote move. state = {}'.format(state))
-            if (self.remoteControl == False):
-                # Send event from EV3 gadget to Alexa
+            if self.state.setIf('remoteControl', False, True):
+                # Send event from EV3 gadget to Alexa, once even if several buttons are pressed together
                 self._send_event(EventName.REMOTECONTROL, {})
-                self.remoteControl = True
             if state:
                 motor.run_forever(speed_sp=speed)
             else:
@@ -431,88 +2596,81 @@ class MindstormsGadget(AlexaGadget):
         return on_press
 
     def remote_useTool(self):
-        # We trigger the weapon if the button in the indicated channel is pressed
+        # We trigger the weapon when the button in the indicated channel is pressed
         def on_press(state):
-            if (self.remoteControl == False):
+            if self.state.setIf('remoteControl', False, True):
                 # Send event from EV3 gadget to Alexa
                 self._send_event(EventName.REMOTECONTROL, {})
-                self.remoteControl = True
-
-            self.sound.play_file('./sounds/Horn.wav')
-
-            if (self.tool == 'gun'):
-                self.weapon.on_for_degrees(SpeedPercent(100), 1000)
-
-            elif (self.tool == 'hammer'):
-                self.weapon.on_for_degrees(SpeedPercent(100), 200)
-                self.weapon.on_for_degrees(SpeedPercent(-50), 200)
 
-            elif (self.tool == 'picker'):
-                if (self.picker == 'pick'):
-                    self.weapon.on_for_degrees(SpeedPercent(100), 90)
-                    self.picker = 'leave'
-                elif (self.picker == 'leave'):
-                    self.weapon.on_for_degrees(SpeedPercent(-100), 90)
-                    self.picker = 'pick'
-
-            elif (self.tool == 'blade'):
-                self.weapon.on_for_degrees(SpeedPercent(100), 360)
-                self.weapon.on_for_degrees(SpeedPercent(-100), 360)
+            tool = TOOLS.get(self.state.read().tool)
+            # The weapon moves in its own thread so the sensor scheduler keeps polling, a press while it moves is ignored
+            if state and tool is not None and self.remoteFiring.acquire(blocking=False):
+                threading.Thread(target=self._fire_remote, args=(tool,), daemon=True).start()
 
         return on_press
 
+    def _fire_remote(self, tool):
+        try:
+            self.fireTool(tool, './sounds/Horn.wav')
+        finally:
+            self.remoteFiring.release()
+
     def beacon_activation(self):
-        print("beacon activated: {}".format(self.ir.beacon(channel=4)))
-        if (self.ir.beacon(4) == True):
-            self.beacon = True
-        elif (self.ir.beacon(4) == False):
-            self.beacon = False
-
-    def _remote_control(self):
-        # This thread checks if the Infra ted remote control is being used and process the pressing button event
-        time.sleep(3)
-        while True:
-            self.ir.process()
-            time.sleep(0.1)
-    
+        # The beacon state changes when the beacon button of the remote on channel 4 is switched
+        def on_change(state):
+            print("beacon activated: {}".format(state))
+            self.state.update(beacon=state)
+        return on_change
+
     def _touch_sensor(self):
-        # This thread checks if the touch sensor is pressed and once is pressed it changes the robot position to home
-        while True:
-            self.ts.wait_for_pressed()     
-            if (self.remoteControl == True):
-                self.sound.beep()
+        # Polled by the sensor scheduler, once the touch sensor is pressed it changes the robot position to home
+        pressed = self.ts.is_pressed
+        if pressed and not self.touchPressed and time.monotonic() - self.touchHandledAt >= 1:
+            self.touchHandledAt = time.monotonic()
+            if self.state.read().remoteControl == True:
+                self.audio.play_file('./sounds/Blip.wav')
                 self.setPosition(1.0, 1.0, 0.0)
-                self.toPlace = 'home'
-                self.fromPlace = 'home'
+                self.state.update(toPlace='home', fromPlace='home', remoteControl=False)
                 # Send event from EV3 gadget to Alexa
                 self._send_event(EventName.HOMEBUTTON, {'place': "home"})    
-                self.remoteControl = False
-            time.sleep(1)
-
-    def _find_color(self):
-        # This thread checks if the finding color directive is on and then it goes to the color line and search the indicated color
+                self.saveState()
+        self.touchPressed = pressed
+
+    def _record_color(self, color):
+        # Called from the color sampler during a sweep with every sample, indexed by the distance along the colors line
+        pose = self.odometry.pose
+        startX, startY = self.toPlaces['colorsLineStart'][:2]
+        endX, endY = self.toPlaces['colorsLineEnd'][:2]
+        length = math.hypot(endX - startX, endY - startY)
+        position = ((pose.x - startX) * (endX - startX) + (pose.y - startY) * (endY - startY)) / length
+        if 0 <= position <= length:
+            self.colorIndex.record(position, color)
+
+    def _color_found(self, detectedColor, detectedAt, command=None):
+        # Called from the color sampler when the target color is detected, the robot stops and sends an event to Alexa
         while True:
-            time.sleep(0.3)
-            while self.findColorOn:
-                targetColor= self.targetColor
-                detectedColor = self.cs.color_name # 0: No color, 1: Black, 2: Blue, 3: Green, 4: Yellow, 5: Red, 6: White, 7: Brown
-                if (targetColor == detectedColor):
-                    # If the target color is detected robot sends an event to Alexa and stops
-                    self.drive.off()
-                    self.ColorFound = True
-                    self.findColorOn = False
-                    self._send_event(EventName.FINDCOLOR, {'color': detectedColor})
-                    self.sound.play_file('./sounds/Horn.wav')
-                    self.sound.speak('That color is here')
-                    self.remoteControl = True
-                    time.sleep(0.3)
+            current = self.state.read()
+            if not current.findColorOn:
+                # The search ended, preempted or at the end of the line, while this sample was being taken
+                return
+            if self.state.compareAndSet(current, colorFound=True, findColorOn=False, remoteControl=True) is not None:
+                break
+        self.drive.off()
+        self.colors.reactions.append(time.monotonic() - detectedAt)
+        self._send_event(EventName.FINDCOLOR, {'color': detectedColor}, command)
+        self.audio.play_file('./sounds/Horn.wav')
+        self.audio.speak('That color is here')
+        print('Color {} found, sampler stats: {}'.format(detectedColor, self.colors.stats()))
 
 if __name__ == '__main__':
     # Startup sequence
     gadget = MindstormsGadget()
-    gadget.sound.play_song((('C4', 'e'), ('D4', 'e'), ('E5', 'q')))
+    # Play the startup song in the background so the Bluetooth connection starts right away
+    threading.Thread(target=gadget.sound.play_song, args=((('C4', 'e'), ('D4', 'e'), ('E5', 'q')),), daemon=True).start()
     gadget.leds.set_color('LEFT', 'GREEN')
     gadget.leds.set_color('RIGHT', 'GREEN')
+    if os.path.exists(FLEET_SOCKET):
+        gadget.joinFleet()
 
     # Gadget main entry point
     gadget.main()
@@ -0,0 +1,447 @@
+
+import sys
+import time
+import math
+import types
+import threading
+from collections import deque
+from time import sleep
+
+from PIL import Image
+
+# Ports of the simulated brick, same names as ev3dev2.motor
+OUTPUT_A = 'outA'
+OUTPUT_B = 'outB'
+OUTPUT_C = 'outC'
+OUTPUT_D = 'outD'
+
+# Colors of the tiles laid along the colors line, from colorsLineStart to colorsLineEnd, and of the floor
+COLORS_LINE_TILES = ('Red', 'Green', 'Blue', 'Yellow')
+FLOOR_COLOR = 'White'
+
+# Width of a tile and distance from the colors line at which the color sensor still sees it, in milimiters
+TILE_WIDTH = 60.0
+LINE_WIDTH = 30.0
+
+# Size of the EV3 LCD
+LCD_SIZE = (178, 128)
+
+
+class SimClock(object):
+    '''
+    Virtual clock of the simulated brick. It runs speedup times faster than the real one, so the
+    motors cover their degrees in a fraction of the real time when benchmarks do not need real time.
+    '''
+
+    def __init__(self, speedup=1.0):
+        self.speedup = speedup
+        self.origin = time.monotonic()
+
+    def now(self):
+        return (time.monotonic() - self.origin) * self.speedup
+
+    # Same interface as lego.Clock, so the sensor scheduler and the polling loops of the gadget can run on it
+    def sleep(self, seconds):
+        sleep(seconds / self.speedup)
+
+    def wait(self, event, timeout):
+        return event.wait(None if timeout is None else timeout / self.speedup)
+
+
+class SimBrick(object):
+    '''
+    State of the simulated EV3: the motors by port, the sensors inputs, the field the robot drives on
+    and the log of every motor command and custom event, used to measure the gadget.
+    '''
+
+    def __init__(self, speedup=1.0):
+        self.clock = SimClock(speedup)
+        self.motors = {}
+        self.field = None
+        self.touch = False
+        self.buttons = {}
+        self.beacon = None
+        self.commands = deque(maxlen=10000)
+        self.events = deque(maxlen=1000)
+        self.frames = 0
+        self.sounds = 0
+        self.lock = threading.Lock()
+
+    def motor(self, address, motorClass):
+        with self.lock:
+            if address not in self.motors:
+                self.motors[address] = motorClass.create(address)
+            return self.motors[address]
+
+    def record(self, address, kind):
+        self.commands.append((time.monotonic(), address, kind))
+
+    def idle(self):
+        return not any(motor.is_running for motor in list(self.motors.values()))
+
+
+brick = SimBrick()
+
+
+def reset(speedup=1.0):
+    # Starts over with a new brick, the devices created afterwards are attached to it
+    global brick
+    brick = SimBrick(speedup)
+    return brick
+
+
+class SpeedPercent(object):
+
+    def __init__(self, percent):
+        self.percent = percent
+
+    def to_native_units(self, motor):
+        return self.percent / 100 * motor.max_speed
+
+
+def nativeSpeed(motor, speed):
+    # Like ev3dev2, plain numbers are percentages of the motor maximum speed
+    if hasattr(speed, 'to_native_units'):
+        return speed.to_native_units(motor)
+    return speed / 100 * motor.max_speed
+
+
+class SimMotor(object):
+    '''
+    A tacho motor moving at constant speed on the virtual clock. Its position is computed from the
+    last command when it is read, so nothing runs in the background.
+    '''
+
+    max_speed = 1050
+    count_per_rot = 360
+
+    def __new__(cls, address=OUTPUT_B):
+        # Every device on the same port shares the motor, like MoveTank and LargeMotor do on the brick
+        return brick.motor(address, cls)
+
+    def __init__(self, address=OUTPUT_B):
+        pass
+
+    @classmethod
+    def create(cls, address):
+        motor = object.__new__(cls)
+        motor.address = address
+        motor.lock = threading.Lock()
+        motor.segment = (brick.clock.now(), 0.0, 0.0, None)
+        return motor
+
+    def _position(self, now):
+        started, origin, speed, target = self.segment
+        position = origin + speed * (now - started)
+        if target is not None:
+            position = min(position, target) if speed >= 0 else max(position, target)
+        return position
+
+    def _start(self, speed, target, kind):
+        if brick.field is not None:
+            # Bring the true pose up to date, the wheels keep constant speeds between two commands
+            brick.field.pose()
+        with self.lock:
+            now = brick.clock.now()
+            position = self._position(now)
+            if target is not None:
+                speed = math.copysign(abs(speed), target - position)
+            self.segment = (now, position, speed, target)
+        brick.record(self.address, kind)
+
+    @property
+    def position(self):
+        return int(round(self._position(brick.clock.now())))
+
+    @property
+    def is_running(self):
+        started, origin, speed, target = self.segment
+        if speed == 0:
+            return False
+        return target is None or self._position(brick.clock.now()) != target
+
+    @property
+    def state(self):
+        return ['running'] if self.is_running else []
+
+    def on_for_degrees(self, speed, degrees, brake=True, block=True):
+        speed = nativeSpeed(self, speed)
+        degrees = degrees if speed >= 0 else -degrees
+        self._start(speed, self._position(brick.clock.now()) + degrees, 'on_for_degrees')
+        if block:
+            self.wait_until_not_moving()
+
+    def run_forever(self, speed_sp=0):
+        self._start(speed_sp, None, 'run_forever')
+
+    def stop(self):
+        self._start(0.0, None, 'stop')
+
+    def off(self, brake=True):
+        self._start(0.0, None, 'off')
+
+    def wait_until(self, state, timeout=None):
+        return self._wait(lambda: state in self.state, timeout)
+
+    def wait_while(self, state, timeout=None):
+        return self._wait(lambda: state not in self.state, timeout)
+
+    def wait_until_not_moving(self, timeout=None):
+        return self._wait(lambda: not self.is_running, timeout)
+
+    def _wait(self, condition, timeout):
+        # Timeouts are in milliseconds of real time, like ev3dev2
+        deadline = None if timeout is None else time.monotonic() + timeout / 1000
+        while not condition():
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            sleep(0.005)
+        return True
+
+
+class LargeMotor(SimMotor):
+    max_speed = 1050
+
+
+class MediumMotor(SimMotor):
+    max_speed = 1560
+
+
+class MoveTank(object):
+
+    def __init__(self, left_motor_port, right_motor_port):
+        self.left_motor = LargeMotor(left_motor_port)
+        self.right_motor = LargeMotor(right_motor_port)
+
+    def on_for_degrees(self, left_speed, right_speed, degrees, brake=True, block=True):
+        # The faster motor turns the given degrees and the other one proportionally, like ev3dev2
+        left = nativeSpeed(self.left_motor, left_speed)
+        right = nativeSpeed(self.right_motor, right_speed)
+        if degrees == 0 or (left == 0 and right == 0):
+            leftDegrees = rightDegrees = degrees
+        elif abs(left) > abs(right):
+            leftDegrees = degrees
+            rightDegrees = abs(right / left) * degrees
+        else:
+            leftDegrees = abs(left / right) * degrees
+            rightDegrees = degrees
+        self.left_motor.on_for_degrees(SpeedPercent(100 * left / self.left_motor.max_speed), leftDegrees, brake, block=False)
+        self.right_motor.on_for_degrees(SpeedPercent(100 * right / self.right_motor.max_speed), rightDegrees, brake, block=False)
+        if block:
+            self.left_motor.wait_until_not_moving()
+            self.right_motor.wait_until_not_moving()
+
+    def on(self, left_speed, right_speed):
+        self.left_motor.run_forever(nativeSpeed(self.left_motor, left_speed))
+        self.right_motor.run_forever(nativeSpeed(self.right_motor, right_speed))
+
+    def off(self, brake=True):
+        self.left_motor.off(brake)
+        self.right_motor.off(brake)
+
+
+class SimField(object):
+    '''
+    The field the simulated robot drives on, built from the places and targets of the gadget, with
+    the tiles of the colors line. The true pose of the robot comes from the drive motors.
+    '''
+
+    def __init__(self, places, targets, wheelRadius=16.8, distanceWheels=100.0, tiles=COLORS_LINE_TILES, pose=(0.0, 0.0, 0.0)):
+        self.places = places
+        self.targets = targets
+        self.degreeLength = 2 * math.pi * wheelRadius / 360
+        self.distanceWheels = distanceWheels
+        self.tiles = self._layTiles(tiles)
+        self.lock = threading.Lock()
+        self.left = LargeMotor(OUTPUT_B)
+        self.right = LargeMotor(OUTPUT_C)
+        self.place(*pose)
+
+    def _layTiles(self, tiles):
+        # Tiles evenly spread along the colors line, as (x, y, color)
+        startX, startY = self.places['colorsLineStart'][:2]
+        endX, endY = self.places['colorsLineEnd'][:2]
+        return [(startX + (endX - startX) * (index + 1) / (len(tiles) + 1),
+                 startY + (endY - startY) * (index + 1) / (len(tiles) + 1), color)
+                for index, color in enumerate(tiles)]
+
+    def place(self, x, y, orientation):
+        with self.lock:
+            self.leftPosition = self.left.position
+            self.rightPosition = self.right.position
+            self.truePose = (x, y, orientation)
+
+    def pose(self):
+        with self.lock:
+            leftPosition, rightPosition = self.left.position, self.right.position
+            left = (leftPosition - self.leftPosition) * self.degreeLength
+            right = (rightPosition - self.rightPosition) * self.degreeLength
+            self.leftPosition, self.rightPosition = leftPosition, rightPosition
+            x, y, orientation = self.truePose
+            # Same conventions as the gadget: a positive turn runs the left wheel forwards. The wheel speeds
+            # are constant since the last motor command, so the robot moved along an exact circular arc
+            rotation = (left - right) / (2 * self.distanceWheels)
+            travel = (left + right) / 2
+            if abs(rotation) < 1e-9:
+                x += travel * math.cos(orientation)
+                y += travel * math.sin(orientation)
+            else:
+                radius = travel / rotation
+                x += radius * (math.sin(orientation + rotation) - math.sin(orientation))
+                y -= radius * (math.cos(orientation + rotation) - math.cos(orientation))
+            self.truePose = (x, y, (orientation + rotation) % (2 * math.pi))
+            return self.truePose
+
+    def colorAt(self, x, y):
+        for tileX, tileY, color in self.tiles:
+            if abs(x - tileX) <= TILE_WIDTH / 2 and abs(y - tileY) <= LINE_WIDTH:
+                return color
+        return FLOOR_COLOR
+
+
+class ColorSensor(object):
+    MODE_COL_COLOR = 'COL-COLOR'
+
+    def __init__(self, address=None):
+        self.mode = self.MODE_COL_COLOR
+
+    @property
+    def color_name(self):
+        if brick.field is None:
+            return FLOOR_COLOR
+        x, y, orientation = brick.field.pose()
+        return brick.field.colorAt(x, y)
+
+
+class InfraredSensor(object):
+    '''
+    Infrared sensor seeing the beacon placed on the field, with the remote buttons pressed through
+    SimBrick.buttons[(channel, button)]. The sensor points backwards, like on the robot.
+    '''
+
+    def __init__(self, address=None):
+        self.previous = {}
+
+    def process(self):
+        for (channel, button), state in list(brick.buttons.items()):
+            if self.previous.get((channel, button), False) != state:
+                self.previous[(channel, button)] = state
+                handler = getattr(self, 'on_channel{}_{}'.format(channel, button), None)
+                if callable(handler):
+                    handler(state)
+
+    def _beacon(self, channel):
+        if brick.beacon is None or brick.field is None or channel != 4:
+            return None
+        x, y, orientation = brick.field.pose()
+        beaconX, beaconY = brick.beacon
+        angle = math.atan2(beaconY - y, beaconX - x) - (orientation + math.pi)
+        angle = (angle + math.pi) % (2 * math.pi) - math.pi
+        return math.degrees(angle), math.hypot(beaconX - x, beaconY - y)
+
+    def heading(self, channel=1):
+        beacon = self._beacon(channel)
+        return 0 if beacon is None else max(-25, min(25, int(beacon[0])))
+
+    def distance(self, channel=1):
+        # Percentage of the 700 milimiters range
+        beacon = self._beacon(channel)
+        return None if beacon is None else min(100, int(beacon[1] / 7))
+
+    def heading_and_distance(self, channel=1):
+        return self.heading(channel), self.distance(channel)
+
+    def beacon(self, channel=1):
+        return self._beacon(channel) is not None
+
+
+class TouchSensor(object):
+
+    def __init__(self, address=None):
+        pass
+
+    @property
+    def is_pressed(self):
+        return brick.touch
+
+    def wait_for_pressed(self, timeout_ms=None):
+        while not brick.touch:
+            sleep(0.01)
+        return True
+
+
+class Display(object):
+    '''
+    LCD with a 32 bits framebuffer like the EV3 one, the rows written by the HUD are counted apart.
+    '''
+
+    def __init__(self):
+        self.image = Image.new('RGB', LCD_SIZE, 'white')
+        self.var_info = types.SimpleNamespace(bits_per_pixel=32)
+        self.fix_info = types.SimpleNamespace(line_length=LCD_SIZE[0] * 4)
+        self.mmap = bytearray(LCD_SIZE[0] * 4 * LCD_SIZE[1])
+
+    def update(self):
+        self.mmap[:] = self.image.convert('RGB').tobytes('raw', 'XRGB')
+        brick.frames += 1
+
+
+class Sound(object):
+
+    def beep(self, *args, **kwargs):
+        brick.sounds += 1
+
+    def speak(self, text, *args, **kwargs):
+        brick.sounds += 1
+
+    def play_file(self, path, *args, **kwargs):
+        brick.sounds += 1
+
+    def play_song(self, song, *args, **kwargs):
+        brick.sounds += 1
+
+
+class Leds(object):
+
+    def set_color(self, group, color, pct=1):
+        pass
+
+
+class AlexaGadget(object):
+    '''
+    Transport of the simulated gadget, the custom events are recorded in the brick instead of being sent.
+    '''
+
+    def __init__(self):
+        self.friendly_name = 'Simulated gadget'
+        self.stopped = threading.Event()
+
+    def send_custom_event(self, namespace, name, payload):
+        brick.events.append((time.monotonic(), namespace, name, payload))
+
+    def main(self):
+        self.stopped.wait()
+
+
+def install():
+    '''
+    Registers the simulated devices as the agt and ev3dev2 modules, it has to be called before importing lego.
+    '''
+    this = sys.modules[__name__]
+    modules = {
+        'agt': ['AlexaGadget'],
+        'ev3dev2': [],
+        'ev3dev2.led': ['Leds'],
+        'ev3dev2.sound': ['Sound'],
+        'ev3dev2.motor': ['LargeMotor', 'MediumMotor', 'MoveTank', 'SpeedPercent',
+                          'OUTPUT_A', 'OUTPUT_B', 'OUTPUT_C', 'OUTPUT_D'],
+        'ev3dev2.sensor': [],
+        'ev3dev2.sensor.lego': ['InfraredSensor', 'ColorSensor', 'TouchSensor'],
+        'ev3dev2.display': ['Display']
+    }
+    for name, attributes in modules.items():
+        module = types.ModuleType(name)
+        module.__all__ = attributes
+        for attribute in attributes:
+            setattr(module, attribute, getattr(this, attribute))
+        sys.modules[name] = module